@@ -0,0 +1,167 @@
+"""
+Load test /play and playback for many simulated guilds, fully offline
+
+Run from the repository root:
+    python benchmarks/bench_load.py [--guilds N] [--tracks N] [--playlist N] [--latency S]
+
+yt-dlp is replaced by a canned extractor, audio comes from a local HTTP server and
+voice clients are fakes that pull frames at playback pace. With ffmpeg installed every
+stream runs through a real ffmpeg process, without it frames are read straight from the
+HTTP server and the CPU figures leave out ffmpeg.
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from discord.ext import commands
+import yt_dlp
+import music_source
+from music_commands import register_music_commands
+from music_queue import guild_queues
+from music_scheduler import extraction_scheduler
+from fakes import (
+    FakeYoutubeDL, AudioServer, HttpFrameSource, PlaybackStats, make_test_audio, video_id,
+    FakeGuild, FakeTextChannel, FakeVoiceChannel, FakeInteraction,
+)
+
+def percentile(values, fraction):
+    """Get a percentile from unsorted values, 0.0 when there are none"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def rss_bytes():
+    """Get the resident memory of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is the peak, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def cpu_seconds():
+    """Get the CPU time used by this process and its reaped children, e.g. ffmpeg"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+async def run_guild(play, index, args, stats, play_latencies):
+    """Queue tracks in one guild with /play and wait until its queue has played out"""
+    guild = FakeGuild(1000 + index)
+    text_channel = FakeTextChannel(guild.id * 10)
+    voice_channel = FakeVoiceChannel(guild, stats, args.speed)
+
+    # Staggered so guilds don't all hit the first extraction in the same instant
+    await asyncio.sleep(random.uniform(0, args.ramp))
+
+    queries = [f"benchmark song {index % args.distinct}"]
+    queries += [f"https://www.youtube.com/watch?v={video_id(f'{index}/{i}')}" for i in range(1, args.tracks)]
+    if args.playlist:
+        queries.append(f"https://www.youtube.com/playlist?list=PL{index}-{args.playlist}")
+
+    for query in queries:
+        start = time.perf_counter()
+        await play.callback(FakeInteraction(guild, text_channel, voice_channel), "youtube", query)
+        play_latencies.append(time.perf_counter() - start)
+
+    deadline = time.perf_counter() + args.timeout
+    while guild.voice_client is not None and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    return text_channel
+
+async def run(args):
+    intents = discord.Intents.default()
+    bot = commands.Bot(command_prefix="!", intents=intents)
+    register_music_commands(bot)
+    play = bot.tree.get_command("play")
+
+    stats = PlaybackStats()
+    play_latencies = []
+    rss_before = rss_bytes()
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+
+    text_channels = await asyncio.gather(*(
+        run_guild(play, index, args, stats, play_latencies) for index in range(args.guilds)
+    ))
+
+    elapsed = time.perf_counter() - start
+    cpu_used = cpu_seconds() - cpu_before
+    rss_after = rss_bytes()
+    audio_seconds = stats.frames * 0.02
+    return {
+        "elapsed": elapsed,
+        "play_latencies": play_latencies,
+        "stats": stats,
+        "cpu_used": cpu_used,
+        "audio_seconds": audio_seconds,
+        "rss_delta": rss_after - rss_before,
+        "messages": sum(channel.sent for channel in text_channels),
+        "edits": sum(channel.edits for channel in text_channels),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=20, help="Simulated guilds playing at once")
+    parser.add_argument("--tracks", type=int, default=3, help="Tracks queued per guild, the first by search")
+    parser.add_argument("--playlist", type=int, default=0, help="Also queue a playlist of this many tracks")
+    parser.add_argument("--distinct", type=int, default=None, help="Distinct search queries (default one per guild)")
+    parser.add_argument("--track-seconds", type=float, default=5, help="Length of every track")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed-up, 1 is real time")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per simulated extraction")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of extractions that fail")
+    parser.add_argument("--transcode", action="store_true", help="Report a non-Opus codec so ffmpeg re-encodes")
+    parser.add_argument("--ramp", type=float, default=1.0, help="Seconds over which guilds start")
+    parser.add_argument("--timeout", type=float, default=600, help="Give up on a guild after this long")
+    args = parser.parse_args()
+    args.distinct = args.distinct or args.guilds
+
+    with tempfile.TemporaryDirectory() as directory:
+        path, real_audio = make_test_audio(directory, args.track_seconds)
+        server = AudioServer(path)
+        server.start()
+
+        # Swap in the canned extractor, the real pool and scheduler still run around it
+        FakeYoutubeDL.audio_base_url = server.base_url
+        FakeYoutubeDL.track_seconds = args.track_seconds
+        FakeYoutubeDL.latency = args.latency
+        FakeYoutubeDL.failure_rate = args.failure_rate
+        FakeYoutubeDL.acodec = "aac" if args.transcode else "opus"
+        yt_dlp.YoutubeDL = FakeYoutubeDL
+        extraction_scheduler.use_processes = False
+        if not real_audio:
+            print("ffmpeg not found, frames are read straight from HTTP and CPU leaves out ffmpeg")
+            music_source._create_ffmpeg_source = lambda track, start_offset=0, encoding=None, gain=None: HttpFrameSource(track.stream_url, start_offset)
+
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            server.stop()
+
+    stats = results["stats"]
+    latencies = results["play_latencies"]
+    streams = args.guilds * (args.tracks + args.playlist)
+    memory = guild_queues.stats()
+    print(f"guilds: {args.guilds}, tracks per guild: {args.tracks + args.playlist}, wall time: {results['elapsed']:.1f}s")
+    print(f"/play latency:      p50 {percentile(latencies, 0.5) * 1000:8.1f} ms   p99 {percentile(latencies, 0.99) * 1000:8.1f} ms")
+    print(f"first frame:        p50 {percentile(stats.first_frame_latencies, 0.5) * 1000:8.1f} ms   p99 {percentile(stats.first_frame_latencies, 0.99) * 1000:8.1f} ms")
+    print(f"track transition:   p50 {percentile(stats.transition_gaps, 0.5) * 1000:8.1f} ms   p99 {percentile(stats.transition_gaps, 0.99) * 1000:8.1f} ms")
+    print(f"audio played:       {results['audio_seconds']:.0f}s of {streams * args.track_seconds:.0f}s, {stats.errors} playback errors")
+    if results["audio_seconds"]:
+        print(f"CPU per stream:     {results['cpu_used'] / results['audio_seconds'] * 1000:.1f} ms per second of audio")
+    print(f"memory per guild:   {results['rss_delta'] / args.guilds / 1024:.1f} KiB RSS growth, "
+          f"{memory['memory_bytes'] / max(memory['guilds'], 1) / 1024:.1f} KiB queue state estimate")
+    print(f"extractions:        {FakeYoutubeDL.extractions}, scheduler wait p95 {extraction_scheduler.stats()['wait_p95'] * 1000:.1f} ms")
+    print(f"messages:           {results['messages']} sent, {results['edits']} edits")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark the search result ranking against the difflib title matcher
+
+Run from the repository root:
+    python benchmarks/bench_ranking.py [--queries N]
+
+Each query gets ten synthetic results in which the original upload competes with
+covers, lyric videos, live versions and long mixes. Both matchers are timed over the
+same batches and scored on how often they pick the original.
+"""
+import argparse
+import difflib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_ranking import pick_best_match
+
+ARTISTS = ["Daft Punk", "Adele", "Queen", "Billie Eilish", "Arctic Monkeys", "Dua Lipa", "Radiohead", "The Weeknd"]
+WORDS = ["night", "fire", "heart", "summer", "lights", "dream", "river", "gold", "city", "dance", "blue", "rain"]
+
+def find_best_match(tracks, original_query):
+    """The title matcher /play used before the ranking, kept as the baseline"""
+    # Clean the original query for better matching
+    clean_query = original_query.lower().strip()
+    
+    # Extract just the search term from search prefix if present
+    if ":" in clean_query:
+        parts = clean_query.split(":", 1)
+        if len(parts) > 1 and parts[0].endswith("search"):
+            clean_query = parts[1].strip()
+    
+    # If there's only one result, return it
+    if len(tracks) == 1:
+        return tracks[0]
+    
+    # Compare each track title with the query
+    best_match = None
+    highest_ratio = 0
+    
+    for track in tracks:
+        if track is None or "title" not in track:
+            continue
+            
+        title = track["title"].lower()
+        ratio = difflib.SequenceMatcher(None, clean_query, title).ratio()
+        
+        # Boost ratio if exact words from query appear in title
+        query_words = clean_query.split()
+        for word in query_words:
+            if word in title and len(word) > 2:  # Only count meaningful words
+                ratio += 0.1
+                
+        if ratio > highest_ratio:
+            highest_ratio = ratio
+            best_match = track
+    
+    # Return the best match or the first track if no good match
+    return best_match if best_match else tracks[0]
+
+def make_batch(rng):
+    """Build one query and its shuffled results, returning them with the original upload"""
+    artist = rng.choice(ARTISTS)
+    song = " ".join(rng.sample(WORDS, rng.randint(1, 3))).title()
+    original = {
+        "title": rng.choice([song, f"{song} (Official Audio)", f"{artist} - {song} (Official Video)"]),
+        "uploader": f"{artist} - Topic" if rng.random() < 0.5 else artist,
+        "duration": rng.randint(150, 300),
+        "view_count": rng.randint(10 ** 6, 10 ** 9),
+    }
+    variants = [
+        {"title": f"{song} - {artist} (Lyrics)", "uploader": "Lyric Vibes", "duration": original["duration"]},
+        {"title": f"{artist} - {song} (Cover)", "uploader": "Cover Nation", "duration": original["duration"] + 10},
+        {"title": f"{artist} - {song} Live at Wembley", "uploader": artist, "duration": original["duration"] + 60},
+        {"title": f"{song} 1 Hour Loop", "uploader": "Loops", "duration": 3600},
+        {"title": f"{artist} {song} Karaoke Version", "uploader": "Sing King", "duration": original["duration"]},
+        {"title": f"{song} (Nightcore)", "uploader": "Nightcore Daily", "duration": original["duration"] - 30},
+        {"title": f"{artist} - {song} [Slowed + Reverb]", "uploader": "Chill Edits", "duration": original["duration"] + 40},
+        {"title": f"{artist} Greatest Hits", "uploader": "Best Of", "duration": 5400},
+        {"title": f"Reacting to {artist} - {song}", "uploader": "React Guy", "duration": 900},
+    ]
+    for variant in variants:
+        variant["view_count"] = rng.randint(10 ** 4, original["view_count"])
+    results = [original] + variants
+    rng.shuffle(results)
+    return f"{artist} {song}".lower(), results, original
+
+def run(matcher, batches):
+    """Time a matcher over every batch and count how often it picked the original"""
+    correct = 0
+    start = time.perf_counter()
+    for query, results, original in batches:
+        correct += matcher(results, query) is original
+    return (time.perf_counter() - start) / len(batches) * 1e6, correct / len(batches)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    batches = [make_batch(rng) for _ in range(args.queries)]
+    for name, matcher in (("difflib", find_best_match), ("ranked", pick_best_match)):
+        micros, accuracy = run(matcher, batches)
+        print(f"{name:>8}: {micros:8.1f} us/query, picked the original {accuracy:6.1%}")
+
+if __name__ == "__main__":
+    main()
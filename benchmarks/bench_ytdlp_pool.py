@@ -0,0 +1,58 @@
+"""
+Benchmark YoutubeDL construction per call against the pooled instances
+
+Run from the repository root:
+    python benchmarks/bench_ytdlp_pool.py [--calls N] [--url URL]
+
+Without --url only the per-call setup is measured (no network). With --url every
+call also extracts that URL, which includes the HTTP connection setup the pool reuses.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+from config import YDL_BASE_OPTIONS
+from music_ytdlp import MyLogger, YoutubeDLPool
+
+def run_fresh(calls, url):
+    """Build a new YoutubeDL for every call, as _extract used to"""
+    for _ in range(calls):
+        with yt_dlp.YoutubeDL(dict(YDL_BASE_OPTIONS, logger=MyLogger())) as ydl:
+            _use(ydl, url)
+
+def run_pooled(calls, url):
+    """Borrow a long-lived YoutubeDL from the pool for every call"""
+    pool = YoutubeDLPool(1)
+    for _ in range(calls):
+        with pool.checkout(YDL_BASE_OPTIONS) as ydl:
+            _use(ydl, url)
+    pool.close_all()
+
+def _use(ydl, url):
+    """Do the per-call work, an extraction or just the extractor lookup"""
+    if url:
+        ydl.extract_info(url, download=False)
+    else:
+        ydl.get_info_extractor("Youtube")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--url", help="Extract this URL on every call (uses the network)")
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in (("fresh", run_fresh), ("pooled", run_pooled)):
+        start = time.perf_counter()
+        func(args.calls, args.url)
+        results[name] = (time.perf_counter() - start) / args.calls * 1000
+        print(f"{name:>7}: {results[name]:8.2f} ms/call")
+
+    print(f"saving: {results['fresh'] - results['pooled']:8.2f} ms/call")
+
+if __name__ == "__main__":
+    main()
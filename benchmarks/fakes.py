@@ -0,0 +1,341 @@
+"""
+Offline stand-ins for yt-dlp, the audio CDN and Discord, used by the load benchmark
+
+FakeYoutubeDL answers from a generated catalog with configurable latency and failure
+rate, AudioServer serves the test audio over local HTTP, and the fake Discord objects
+implement just what the command handlers and the player touch.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import re
+import shutil
+import subprocess
+import threading
+import time
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import discord
+
+FRAME_DURATION = 0.02  # Seconds of audio in one Opus frame
+FAKE_FRAME_SIZE = 240  # Bytes in a 20 ms frame at 96 kbps
+
+def video_id(name):
+    """Build a stable 11 character YouTube-style id"""
+    return hashlib.md5(name.encode()).hexdigest()[:11]
+
+class FakeYoutubeDL:
+    """Replaces yt_dlp.YoutubeDL, answering searches, videos and playlists from a catalog
+
+    Configure the class attributes before the first extraction. extract_info sleeps to
+    simulate network latency and raises for a fraction of calls like a failed request.
+    """
+    audio_base_url = "http://127.0.0.1:0/audio"
+    track_seconds = 30
+    latency = 0.2  # Seconds per extraction
+    jitter = 0.5  # Latency varies by up to this fraction
+    failure_rate = 0.0
+    acodec = "opus"
+    extractions = 0
+    lock = threading.Lock()
+
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+
+    def close(self):
+        pass
+
+    def extract_info(self, query, download=False):
+        with FakeYoutubeDL.lock:
+            FakeYoutubeDL.extractions += 1
+        time.sleep(self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.failure_rate:
+            raise Exception("simulated extraction failure")
+
+        search = re.match(r"(?:yt|sc)search(\d*):(.*)", query)
+        if search:
+            return self._search(search.group(2), int(search.group(1) or 1))
+        playlist = re.search(r"list=([\w-]+)", query)
+        if playlist:
+            return self._playlist(playlist.group(1))
+        video = re.search(r"v=([\w-]{11})", query)
+        return self._video(video.group(1) if video else video_id(query))
+
+    def _flat_entry(self, vid, title):
+        return {
+            "_type": "url",
+            "ie_key": "Youtube",
+            "id": vid,
+            "title": title,
+            "url": f"https://www.youtube.com/watch?v={vid}",
+            "duration": self.track_seconds,
+            "uploader": "Benchmark",
+        }
+
+    def _search(self, terms, count):
+        entries = [self._flat_entry(video_id(f"{terms}/{i}"), f"{terms} result {i}") for i in range(count)]
+        entries[0]["title"] = terms
+        return {"_type": "playlist", "id": terms, "title": terms, "entries": entries}
+
+    def _playlist(self, list_id):
+        size = int(list_id.rsplit("-", 1)[-1]) if "-" in list_id else 10
+        start, end = 1, size
+        if self.params.get("playlist_items"):
+            start, end = (int(part) for part in self.params["playlist_items"].split("-"))
+        entries = [
+            self._flat_entry(video_id(f"{list_id}/{i}"), f"{list_id} track {i}")
+            for i in range(start, min(end, size) + 1)
+        ]
+        return {"_type": "playlist", "id": list_id, "title": list_id, "playlist_count": size, "entries": entries}
+
+    def _video(self, vid):
+        expires = int(time.time()) + 6 * 3600
+        return {
+            "id": vid,
+            "extractor_key": "Youtube",
+            "title": f"Video {vid}",
+            "webpage_url": f"https://www.youtube.com/watch?v={vid}",
+            "duration": self.track_seconds,
+            "uploader": "Benchmark",
+            "url": f"{self.audio_base_url}/{vid}.webm?expire={expires}",
+            "acodec": self.acodec,
+            "asr": 48000,
+            "ext": "webm",
+        }
+
+class AudioServer:
+    """Serves one test audio file for every /audio/ path from a local HTTP server"""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/webm")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except ConnectionError:
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/audio"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+def make_test_audio(directory, seconds):
+    """Write the test audio, Opus in WebM with ffmpeg or frame-sized filler without it
+
+    Returns the path and whether it is real audio ffmpeg can play.
+    """
+    path = os.path.join(directory, "test.webm")
+    if shutil.which("ffmpeg"):
+        subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+             "-c:a", "libopus", "-b:a", "96k", path],
+            check=True,
+        )
+        return path, True
+
+    with open(path, "wb") as f:
+        f.write(os.urandom(int(seconds / FRAME_DURATION) * FAKE_FRAME_SIZE))
+    return path, False
+
+class HttpFrameSource(discord.AudioSource):
+    """Streams the test file over HTTP in frame-sized chunks, standing in for ffmpeg"""
+    def __init__(self, url, start_offset=0):
+        self.response = urllib.request.urlopen(url)
+        skip = int(start_offset / FRAME_DURATION) * FAKE_FRAME_SIZE
+        while skip > 0:
+            skipped = len(self.response.read(min(skip, 65536)))
+            if not skipped:
+                break
+            skip -= skipped
+
+    def read(self):
+        frame = self.response.read(FAKE_FRAME_SIZE)
+        return frame if len(frame) == FAKE_FRAME_SIZE else b""
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.response.close()
+
+class PlaybackStats:
+    """Timings gathered by the fake voice clients"""
+    def __init__(self):
+        self.transition_gaps = []
+        self.first_frame_latencies = []
+        self.frames = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+class FakeVoiceClient:
+    """Pulls frames from the source at playback pace on its own thread, like discord's AudioPlayer"""
+    def __init__(self, channel, loop, stats, speed=1.0):
+        self.channel = channel
+        self.guild = channel.guild
+        self.loop = loop
+        self.stats = stats
+        self.speed = speed
+        self.connected = True
+        self.playing = None  # threading.Event cleared to stop the current source
+        self.paused = False
+        self.ended_at = None
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing is not None and not self.paused
+
+    def is_paused(self):
+        return self.playing is not None and self.paused
+
+    def play(self, source, after=None):
+        started = time.perf_counter()
+        if self.ended_at is not None:
+            with self.stats.lock:
+                self.stats.transition_gaps.append(started - self.ended_at)
+        running = threading.Event()
+        running.set()
+        self.playing = running
+        threading.Thread(target=self._run, args=(source, after, running, started), daemon=True).start()
+
+    def _run(self, source, after, running, started):
+        error = None
+        frames = 0
+        next_frame = time.perf_counter()
+        try:
+            while running.is_set():
+                if self.paused:
+                    time.sleep(FRAME_DURATION)
+                    next_frame = time.perf_counter()
+                    continue
+                frame = source.read()
+                if not frame:
+                    break
+                if frames == 0:
+                    with self.stats.lock:
+                        self.stats.first_frame_latencies.append(time.perf_counter() - started)
+                frames += 1
+                next_frame += FRAME_DURATION / self.speed
+                delay = next_frame - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+
+        with self.stats.lock:
+            self.stats.frames += frames
+            self.stats.errors += error is not None
+        if self.playing is running:
+            self.playing = None
+        self.ended_at = time.perf_counter()
+        if after is not None:
+            after(error)
+
+    def stop(self):
+        if self.playing is not None:
+            self.playing.clear()
+            self.playing = None
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild, stats, speed, bitrate=96000):
+        self.id = guild.id * 10 + 1
+        self.guild = guild
+        self.stats = stats
+        self.speed = speed
+        self.bitrate = bitrate
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self, asyncio.get_running_loop(), self.stats, self.speed)
+        return self.guild.voice_client
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.channel.edits += 1
+        self.content = content
+
+class FakeTextChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, content)
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+
+class FakeResponse:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, content=None, **kwargs):
+        await self.channel.send(content)
+
+class FakeFollowup:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, wait=False, **kwargs):
+        return await self.channel.send(content)
+
+class FakeUser:
+    def __init__(self, user_id, voice_channel):
+        self.id = user_id
+        self.voice = type("VoiceState", (), {"channel": voice_channel})()
+
+class FakeInteraction:
+    """An interaction from a user sitting in the guild's voice channel"""
+    def __init__(self, guild, text_channel, voice_channel):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = text_channel
+        self.user = FakeUser(guild.id * 10 + 2, voice_channel)
+        self.response = FakeResponse(text_channel)
+        self.followup = FakeFollowup(text_channel)
@@ -1,24 +1,131 @@
 """
 Bot initialization and setup
 """
+import hashlib
+import json
+import os
 import discord
 from discord.ext import commands
+from config import PERSIST_DB_PATH, PERSIST_FLUSH_INTERVAL, RESUME_PLAYBACK_ON_STARTUP, IDLE_CHECK_INTERVAL
+from config import METRICS_ENABLED, METRICS_HOST, METRICS_PORT, METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL
+from config import COMMAND_TREE_HASH_PATH, FFMPEG_WATCHDOG_INTERVAL, AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES
 from music_commands import register_music_commands
+from music_queue import guild_queues
+from music_persistence import QueueStore
+from music_player import record_playback_positions, resume_playback, discard_prefetch
+from music_idle import run_idle_reaper
+from music_metrics import metrics
+from music_ytdlp import prewarm_extraction
+from music_cache import extraction_cache
+from music_index import track_index
+from music_loudness import loudness_analyzer
+from music_supervisor import ffmpeg_supervisor
+from music_audio_cache import audio_cache
 
-def setup_bot():
-    """Set up and configure the Discord bot"""
+def get_shard_id(guild_id, shard_count):
+    """Get the shard Discord routes a guild to"""
+    return (int(guild_id) >> 22) % shard_count
+
+def get_command_tree_hash(bot):
+    """Hash the registered slash command definitions"""
+    definitions = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda d: d["name"])
+    return hashlib.sha256(json.dumps(definitions, sort_keys=True).encode()).hexdigest()
+
+async def sync_command_tree(bot):
+    """Sync the slash commands with Discord, unless they are unchanged since the last sync"""
+    synced = f"{bot.application_id}:{get_command_tree_hash(bot)}"
+    try:
+        with open(COMMAND_TREE_HASH_PATH) as f:
+            if f.read().strip() == synced:
+                return
+    except OSError:
+        pass
+
+    await bot.tree.sync()
+    with open(COMMAND_TREE_HASH_PATH, "w") as f:
+        f.write(synced)
+    print("Slash commands synced")
+
+def setup_bot(shard_ids=None, shard_count=None):
+    """Set up and configure the Discord bot, optionally for a range of shards"""
     # Set up intents
     intents = discord.Intents.default()
     intents.message_content = True
     
     # Create bot instance
-    bot = commands.Bot(command_prefix="!", intents=intents)
+    if shard_count:
+        bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_ids=shard_ids, shard_count=shard_count)
+    else:
+        bot = commands.Bot(command_prefix="!", intents=intents)
+    
+    # Restore the queues saved before the last shutdown, only for guilds on our shards
+    if PERSIST_DB_PATH:
+        keep = None
+        if shard_ids is not None:
+            keep = lambda guild_id: get_shard_id(guild_id, shard_count) in shard_ids
+        guild_queues.restore(QueueStore(PERSIST_DB_PATH), keep)
+
+    # Shard processes each own a subdirectory of the audio cache and their shards' share of its budget
+    if AUDIO_CACHE_DIR:
+        if shard_ids is None:
+            audio_cache.use_directory(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+        else:
+            audio_cache.use_directory(
+                os.path.join(AUDIO_CACHE_DIR, f"shard-{min(shard_ids)}"),
+                AUDIO_CACHE_MAX_BYTES * len(shard_ids) // shard_count,
+            )
+
+    started = False
     
     # Register event handlers
+    @bot.event
+    async def setup_hook():
+        # Runs after login, load yt-dlp while the gateway connects
+        bot.loop.create_task(prewarm_extraction())
+        # Seed /play autocomplete with the tracks cached before the restart
+        track_index.load(extraction_cache.values("metadata"))
+    
+    @bot.event
+    async def on_guild_remove(guild):
+        # Kicked, or the guild was deleted, its queue and settings won't be needed again
+        discard_prefetch(str(guild.id))
+        guild_queues.forget(str(guild.id))
+        track_index.forget_guild(str(guild.id))
+
     @bot.event
     async def on_ready():
-        await bot.tree.sync()
+        nonlocal started
         print(f"{bot.user} is online!")
+        
+        # on_ready also fires after reconnects, only start background work once
+        if started:
+            return
+        started = True
+        # Commands are global, one process syncing them is enough
+        # A failed sync keeps the commands Discord already has, the background work still starts
+        if shard_ids is None or 0 in shard_ids:
+            try:
+                await sync_command_tree(bot)
+            except (discord.DiscordException, OSError) as e:
+                print(f"Slash command sync error: {str(e)}")
+        if guild_queues.store:
+            bot.loop.create_task(guild_queues.store.run(PERSIST_FLUSH_INTERVAL, record_playback_positions))
+        bot.loop.create_task(run_idle_reaper(bot, IDLE_CHECK_INTERVAL))
+        bot.loop.create_task(ffmpeg_supervisor.run(FFMPEG_WATCHDOG_INTERVAL))
+        if loudness_analyzer.enabled:
+            bot.loop.create_task(loudness_analyzer.run())
+        # Shard processes each serve their own metrics, on the port offset by their first shard
+        first_shard = min(shard_ids) if shard_ids else 0
+        if METRICS_ENABLED and METRICS_PORT:
+            try:
+                await metrics.serve(METRICS_HOST, METRICS_PORT + first_shard)
+            except OSError as e:
+                print(f"Metrics server error on port {METRICS_PORT + first_shard}: {str(e)}")
+        if METRICS_ENABLED and METRICS_DUMP_PATH:
+            dump_path = f"{METRICS_DUMP_PATH}.{first_shard}" if shard_ids else METRICS_DUMP_PATH
+            bot.loop.create_task(metrics.dump_periodically(dump_path, METRICS_DUMP_INTERVAL))
+        if RESUME_PLAYBACK_ON_STARTUP:
+            await resume_playback(bot)
     
     # Register commands
     register_music_commands(bot)
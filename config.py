@@ -4,6 +4,70 @@ Configuration settings for the music bot
 
 # Playlist configuration
 MAX_PLAYLIST_SIZE = 100
+PLAYLIST_FIRST_CHUNK_SIZE = 5  # Small first chunk so playback starts quickly
+PLAYLIST_CHUNK_SIZE = 25  # Entries listed per chunk after the first one
+MAX_VIRTUAL_PLAYLIST_SIZE = 5000  # Entries of one playlist that can be queued, paged in as playback approaches
+PLAYLIST_PAGE_RETRY_LIMIT = 3  # Failed listings of the next chunk before the rest of a playlist is dropped
+PLAYLIST_PAGE_RETRY_BACKOFF = 2.0  # Seconds before the first retry, doubled for each one after
+
+# Stream URL resolution (seconds)
+STREAM_URL_DEFAULT_TTL = 60 * 60  # Used when the URL carries no expiry of its own
+STREAM_URL_EXPIRY_MARGIN = 10 * 60  # Re-resolve when the URL is this close to expiring
+
+# Mid-stream failure recovery
+STREAM_RETRY_LIMIT = 3  # Attempts to re-resolve and resume a track before skipping it
+STREAM_RETRY_BACKOFF = 1.0  # Seconds before the first attempt, doubled for each one after
+STREAM_EARLY_END_TOLERANCE = 5  # Seconds short of the duration that still count as played through
+
+# Extraction worker pool
+EXTRACTION_WORKERS = 4
+EXTRACTION_USE_PROCESSES = False  # Worker processes sidestep the GIL for yt-dlp's parsing
+
+# Extraction cache settings
+CACHE_MAX_ENTRIES = 5000
+CACHE_TTLS = {  # seconds per kind of cached result
+    "search": 6 * 60 * 60,  # Flat search results and playlist listings
+    "metadata": 7 * 24 * 60 * 60,  # Title, uploader, duration of a track
+    "stream": 60 * 60,  # Full extraction results, bounded by the stream URL's own expiry
+}
+CACHE_DB_PATH = None  # e.g. "cache.sqlite3" to keep the cache across restarts
+
+# Prefetch settings
+PREFETCH_LEAD_SECONDS = 15  # Warm up the next track this long before the current one ends
+
+# Queue persistence
+PERSIST_DB_PATH = "queue_state.sqlite3"  # None keeps queues in memory only
+PERSIST_FLUSH_INTERVAL = 5  # Seconds between batched writes
+RESUME_PLAYBACK_ON_STARTUP = False  # Rejoin voice channels and resume where playback stopped
+
+# Sharding, None runs one shard, more processes spread the shards over CPU cores
+SHARD_COUNT = None
+SHARD_PROCESSES = 1
+EXTRACTION_SOCKET_PATH = "extraction.sock"  # Shard processes share extraction and its cache over this
+
+# Startup
+COMMAND_TREE_HASH_PATH = ".command_tree_hash"  # Slash commands are only synced when this hash changes
+
+# Idle guild reclamation (seconds)
+IDLE_CHECK_INTERVAL = 60
+IDLE_DISCONNECT_SECONDS = 5 * 60  # Leave voice after this long without playing anything
+IDLE_EVICT_SECONDS = 60 * 60  # Drop a guild's state from memory after this long without activity
+
+# Status messages (seconds)
+STATUS_EDIT_INTERVAL = 1.5  # Edits to a command's status message are coalesced within this window
+NOW_PLAYING_MIN_INTERVAL = 10  # At most one "Now playing" message per channel in this window
+
+# /play autocomplete, served from an in-memory index of known tracks
+AUTOCOMPLETE_MAX_TRACKS = 20000  # Tracks indexed across every guild
+AUTOCOMPLETE_GUILD_HISTORY = 200  # Played tracks remembered per guild, ranked first
+AUTOCOMPLETE_MAX_SUGGESTIONS = 25  # Discord shows at most 25 choices
+
+# Metrics, latency histograms and counters for the hot paths
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108  # Prometheus text endpoint, None to disable it, shard processes add their first shard id
+METRICS_DUMP_PATH = None  # e.g. "metrics.prom" to also write the metrics to a file, suffixed by first shard id when sharded
+METRICS_DUMP_INTERVAL = 60  # Seconds between dumps
 
 # Platform settings
 PLATFORMS = ["youtube", "soundcloud"]
@@ -11,8 +75,49 @@ PLATFORMS = ["youtube", "soundcloud"]
 # FFmpeg settings
 FFMPEG_OPTIONS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-    "options": "-vn -c:a libopus -b:a 96k",
+    "options": "-vn",
 }
+FFMPEG_BITRATE = 96  # kbps, used when transcoding for a channel that reports no bitrate
+
+# ffmpeg supervision, the limits apply per bot process, each shard process has its own
+FFMPEG_MAX_TRANSCODES = 32  # Concurrent ffmpeg processes running an Opus encoder, remuxes and analyses aren't capped
+FFMPEG_ADMISSION_TIMEOUT = 5  # Seconds new playback waits for a transcode slot before it is degraded
+FFMPEG_STALL_SECONDS = 20  # Kill ffmpeg when a read has waited this long for audio, the stream is then retried
+FFMPEG_WATCHDOG_INTERVAL = 5  # Seconds between stall checks and usage samples
+
+# Loudness normalization, tracks are measured in the background and corrected on later plays
+# Most commercial masters get a correction, and a corrected track is always re-encoded
+# instead of passed through, so enabling this costs an Opus encode on nearly every replay
+# plus a second download of every new track for the analysis
+LOUDNESS_ENABLED = False
+LOUDNESS_DB_PATH = "loudness.sqlite3"  # Measurements kept across restarts, None keeps them in memory only
+LOUDNESS_MEMORY_ENTRIES = 10000  # Measurements held in memory in front of the database
+LOUDNESS_TARGET = -16.0  # Integrated loudness to aim for, LUFS
+LOUDNESS_MAX_TRUE_PEAK = -1.0  # The gain never pushes peaks above this, dBTP
+LOUDNESS_MAX_GAIN = 12.0  # Largest correction either way, dB
+LOUDNESS_MIN_GAIN = 0.5  # Smaller corrections are skipped so the track can still be passed through, dB
+LOUDNESS_ANALYSIS_SECONDS = 600  # Only the start of long tracks and mixes is measured
+LOUDNESS_ANALYSIS_TIMEOUT = 300  # Give up on one analysis after this long, seconds
+LOUDNESS_ANALYSIS_INTERVAL = 5  # Pause between analyses, seconds
+LOUDNESS_MAX_LOAD = 0.5  # Analysis waits while the load average per CPU core is above this
+LOUDNESS_QUEUE_SIZE = 200  # Tracks waiting for analysis, the oldest are dropped
+
+# Channel-aware Opus encoding, the bitrate follows the voice channel's and steps down under load
+ENCODE_MIN_BITRATE = 32  # kbps
+ENCODE_MAX_BITRATE = 384  # kbps, the most a boosted server's channel allows
+ENCODE_COMPLEXITY = 10  # libopus compression level, 0 is fastest and 10 sounds best
+ENCODE_LOAD_STEPS = (  # (load average per core, bitrate factor, complexity), highest load first
+    (0.9, 0.5, 3),
+    (0.7, 0.75, 6),
+)
+
+# Shared playback, one ffmpeg process per (track, start offset) fanned out to every guild playing it
+BROADCAST_ENABLED = False
+BROADCAST_BUFFER_FRAMES = 500  # 20 ms frames kept for listeners slightly behind (10 seconds)
+
+# On-disk cache of encoded audio for replayed tracks
+AUDIO_CACHE_DIR = None  # e.g. "audio_cache" to enable it, shard processes each use a shard-<first shard id> subdirectory
+AUDIO_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Split between shard processes by their number of shards
 
 # YT-DLP Options
 YDL_BASE_OPTIONS = {
@@ -1,15 +1,32 @@
 """
 Discord Music Bot - Main Entry Point
 """
+import argparse
 import os
 from dotenv import load_dotenv
+from config import SHARD_COUNT, SHARD_PROCESSES, EXTRACTION_SOCKET_PATH
 from bot import setup_bot
+from music_queue import guild_queues
+from music_service import run_sharded
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 
 if __name__ == "__main__":
-    # Set up and run the bot
-    bot = setup_bot()
-    bot.run(TOKEN)
+    parser = argparse.ArgumentParser(description="Discord music bot")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="Total number of Discord shards")
+    parser.add_argument("--processes", type=int, default=SHARD_PROCESSES, help="Processes to spread the shards over")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        # Shard processes plus one shared extraction service in this process
+        run_sharded(TOKEN, args.shards or args.processes, args.processes, EXTRACTION_SOCKET_PATH)
+    else:
+        # Set up and run the bot
+        bot = setup_bot(shard_count=args.shards)
+        bot.run(TOKEN)
+        
+        # Write out the last queue changes before exiting
+        if guild_queues.store:
+            guild_queues.store.close()
@@ -0,0 +1,221 @@
+"""
+On-disk LRU cache of encoded Opus audio for replayed tracks
+"""
+import os
+import struct
+import threading
+from collections import OrderedDict
+import discord
+from config import AUDIO_CACHE_MAX_BYTES
+
+FRAME_DURATION = 0.02  # Seconds of audio in one Opus frame
+FRAME_HEADER = struct.Struct("<H")  # Frames are stored length-prefixed, one after another
+FILE_SUFFIX = ".opusf"
+PARTIAL_SUFFIX = ".part"
+PLAYTHROUGH_TOLERANCE = 2.0  # Seconds short of the duration that still count as played through
+
+class CachedOpusSource(discord.AudioSource):
+    """Plays Opus frames back from a cache file, no ffmpeg or network needed"""
+    def __init__(self, path, skip_frames=0):
+        self.file = open(path, "rb")
+        for _ in range(skip_frames):
+            if not self._read_frame():
+                break
+
+    def _read_frame(self):
+        """Read the next stored frame, b"" at the end or on a truncated file"""
+        header = self.file.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return b""
+        (length,) = FRAME_HEADER.unpack(header)
+        frame = self.file.read(length)
+        return frame if len(frame) == length else b""
+
+    def read(self):
+        return self._read_frame()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.file.close()
+
+class RecordingSource(discord.AudioSource):
+    """Passes frames through from an upstream source while writing them to the cache"""
+    def __init__(self, cache, key, upstream, duration):
+        self.cache = cache
+        self.key = key
+        self.upstream = upstream
+        self.duration = duration
+        self.partial_path = cache.partial_path(key, self)
+        self.file = open(self.partial_path, "wb")
+        self.frames = 0
+        self.bytes_written = 0
+
+    def read(self):
+        frame = self.upstream.read()
+        if self.file is None:
+            return frame
+
+        if not frame:
+            self._finish()
+            return frame
+
+        self.frames += 1
+        self.bytes_written += FRAME_HEADER.size + len(frame)
+        if self.bytes_written > self.cache.max_bytes // 4:
+            # One track shouldn't push most of the cache out
+            self._discard()
+        else:
+            self.file.write(FRAME_HEADER.pack(len(frame)))
+            self.file.write(frame)
+        return frame
+
+    def is_opus(self):
+        return True
+
+    def _finish(self):
+        """Keep the recording if the track played through, otherwise drop it"""
+        played = self.frames * FRAME_DURATION
+        if self.duration and played < self.duration - PLAYTHROUGH_TOLERANCE:
+            self._discard()
+            return
+
+        # Flush to disk before the rename so a crash never leaves a truncated cache file
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.cache.commit(self.key, self.partial_path)
+
+    def _discard(self):
+        """Drop a partial recording, e.g. after a skip or a stream failure"""
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.partial_path)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        if self.file is not None:
+            self._discard()
+        self.upstream.cleanup()
+
+class AudioCache:
+    """Byte-budgeted LRU of Opus recordings kept in a directory
+
+    The index is only valid while one process owns the directory, shard processes each
+    use a directory of their own.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = None
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # {key: size}, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if directory:
+            self.use_directory(directory, max_bytes)
+
+    def use_directory(self, directory, max_bytes):
+        """Start caching in a directory with a byte budget, indexing the recordings in it"""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._load_index()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _load_index(self):
+        """Index existing recordings by last use and remove leftovers from a crash"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(PARTIAL_SUFFIX):
+                os.remove(path)
+            elif name.endswith(FILE_SUFFIX):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-len(FILE_SUFFIX)], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.files[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + FILE_SUFFIX)
+
+    def partial_path(self, key, recording):
+        # Unique per recording, several guilds may record the same track at once
+        return os.path.join(self.directory, f"{key}.{id(recording)}{PARTIAL_SUFFIX}")
+
+    def open(self, key, start_offset=0):
+        """Open a recording for playback, or None on a miss"""
+        with self.lock:
+            if key not in self.files:
+                self.misses += 1
+                return None
+            self.files.move_to_end(key)
+            self.hits += 1
+
+        path = self.path(key)
+        try:
+            # The modification time records recency across restarts
+            os.utime(path)
+            return CachedOpusSource(path, int(start_offset / FRAME_DURATION))
+        except OSError:
+            self._forget(key)
+            return None
+
+    def record(self, key, upstream, duration):
+        """Wrap an upstream source so its frames are cached once the track plays through"""
+        try:
+            return RecordingSource(self, key, upstream, duration)
+        except OSError as e:
+            print(f"Audio cache error: {str(e)}")
+            return upstream
+
+    def commit(self, key, partial_path):
+        """Move a finished recording into place and evict to stay within budget"""
+        with self.lock:
+            if key in self.files:
+                os.remove(partial_path)
+                return
+            size = os.path.getsize(partial_path)
+            os.replace(partial_path, self.path(key))
+            self.files[key] = size
+            self.total_bytes += size
+            self._evict()
+
+    def _forget(self, key):
+        """Drop a recording that vanished from disk"""
+        with self.lock:
+            self.total_bytes -= self.files.pop(key, 0)
+
+    def _evict(self):
+        """Delete least recently used recordings until the cache fits its budget"""
+        while self.total_bytes > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        """Get hit/miss counters and disk usage"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": len(self.files),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+# Create a global instance, setup_bot gives it this process's directory
+audio_cache = AudioCache(None, AUDIO_CACHE_MAX_BYTES)
@@ -0,0 +1,144 @@
+"""
+Shared audio pipelines fanned out to several voice clients
+"""
+import threading
+from collections import deque
+import discord
+from config import BROADCAST_BUFFER_FRAMES
+
+FRAME_DURATION = 0.02  # Seconds of audio in one Opus frame
+
+class BroadcastPipeline:
+    """One upstream Opus source whose frames are shared by every subscriber
+
+    Frames are pulled from upstream by whichever subscriber is furthest ahead, so the
+    pipeline runs at the pace of its listeners and keeps a bounded window of history
+    for the ones slightly behind.
+    """
+    def __init__(self, key, upstream):
+        self.key = key
+        self.upstream = upstream
+        self.frames = deque()  # Retained frames, frames[0] is frame number self.base
+        self.base = 0
+        self.finished = False
+        self.subscribers = 0
+        self.lock = threading.Lock()  # Guards the frame window
+        self.read_lock = threading.Lock()  # Only one subscriber reads upstream at a time
+
+    def joinable(self):
+        """Check if a new subscriber can still hear this pipeline from the start"""
+        return self.base == 0 and not self.finished
+
+    def frame_at(self, index):
+        """Get a frame by number, b"" at the end, or None if it already left the window"""
+        with self.lock:
+            frame = self._retained(index)
+            if frame is not None or index < self.base:
+                return frame
+
+        with self.read_lock:
+            # Another subscriber may have read it while we waited
+            with self.lock:
+                frame = self._retained(index)
+                if frame is not None:
+                    return frame
+
+            frame = self.upstream.read()
+
+            with self.lock:
+                if not frame:
+                    self.finished = True
+                    return b""
+                self.frames.append(frame)
+                while len(self.frames) > BROADCAST_BUFFER_FRAMES:
+                    self.frames.popleft()
+                    self.base += 1
+                return frame
+
+    def _retained(self, index):
+        """Get a frame from the window, b"" past the end of the stream, else None"""
+        if self.base <= index < self.base + len(self.frames):
+            return self.frames[index - self.base]
+        if self.finished and index >= self.base:
+            return b""
+        return None
+
+class BroadcastSource(discord.AudioSource):
+    """A subscriber's view of a shared pipeline with its own read position
+
+    Pausing or stopping one subscriber doesn't affect the others. A subscriber that
+    falls out of the shared window, e.g. after a long pause, continues on a private
+    source started at its own position.
+    """
+    def __init__(self, hub, pipeline, factory):
+        self.hub = hub
+        self.pipeline = pipeline
+        self.factory = factory  # factory(offset_seconds) -> private Opus source
+        self.position = 0  # Frames read so far
+        self.private = None
+
+    def read(self):
+        if self.private is not None:
+            return self.private.read()
+
+        frame = self.pipeline.frame_at(self.position)
+        if frame is None:
+            self.private = self.factory(self.position * FRAME_DURATION)
+            self._detach()
+            return self.private.read()
+
+        if frame:
+            self.position += 1
+        return frame
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._detach()
+        if self.private is not None:
+            self.private.cleanup()
+            self.private = None
+
+    def _detach(self):
+        """Drop this subscriber's reference to the shared pipeline"""
+        if self.pipeline is not None:
+            self.hub.release(self.pipeline)
+            self.pipeline = None
+
+class BroadcastHub:
+    """Reference-counted registry of shared pipelines keyed by (track, start offset)"""
+    def __init__(self):
+        self.pipelines = {}  # {key: BroadcastPipeline}
+        self.lock = threading.Lock()
+
+    def subscribe(self, key, factory):
+        """Get a source for key, sharing a pipeline that is still at its start"""
+        with self.lock:
+            pipeline = self.pipelines.get(key)
+            if pipeline is None or not pipeline.joinable():
+                pipeline = BroadcastPipeline(key, factory(0))
+                self.pipelines[key] = pipeline
+            pipeline.subscribers += 1
+        return BroadcastSource(self, pipeline, factory)
+
+    def release(self, pipeline):
+        """Drop a subscriber, closing the upstream source after the last one"""
+        with self.lock:
+            pipeline.subscribers -= 1
+            if pipeline.subscribers > 0:
+                return
+            if self.pipelines.get(pipeline.key) is pipeline:
+                del self.pipelines[pipeline.key]
+        pipeline.upstream.cleanup()
+
+    def stats(self):
+        """Get the number of shared pipelines and their subscribers"""
+        with self.lock:
+            return {
+                "pipelines": len(self.pipelines),
+                "subscribers": sum(pipeline.subscribers for pipeline in self.pipelines.values()),
+            }
+
+# Create a global instance
+broadcast_hub = BroadcastHub()
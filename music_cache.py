@@ -0,0 +1,148 @@
+"""
+Extraction and metadata cache with TTL and LRU eviction
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from config import CACHE_MAX_ENTRIES, CACHE_TTLS, CACHE_DB_PATH
+
+class ExtractionCache:
+    """Size-bounded LRU cache for yt-dlp results, optionally backed by SQLite"""
+    def __init__(self, max_entries, ttls, db_path=None):
+        self.max_entries = max_entries
+        self.ttls = ttls  # {kind: seconds}
+        self.entries = OrderedDict()  # {(kind, key): (expires_at, value)}
+        self.hits = {kind: 0 for kind in ttls}
+        self.misses = {kind: 0 for kind in ttls}
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_writes = 0
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        """Open the SQLite store and drop entries that expired while offline"""
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "kind TEXT, key TEXT, expires_at REAL, accessed_at REAL, value TEXT, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self._prune_db()
+
+    def get(self, kind, key):
+        """Get a cached value, or None if it is missing or expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is not None and entry[0] <= now:
+                del self.entries[(kind, key)]
+                entry = None
+
+            if entry is None and self.db is not None:
+                entry = self._load_from_db(kind, key, now)
+                if entry is not None:
+                    self._store(kind, key, entry)
+
+            if entry is None:
+                self.misses[kind] += 1
+                return None
+
+            self.entries.move_to_end((kind, key))
+            self.hits[kind] += 1
+            return entry[1]
+
+    def set(self, kind, key, value, ttl=None):
+        """Cache a value for its kind's TTL, or a shorter explicit one"""
+        ttl = self.ttls[kind] if ttl is None else min(ttl, self.ttls[kind])
+        if ttl <= 0:
+            return
+
+        entry = (time.time() + ttl, value)
+        with self.lock:
+            self._store(kind, key, entry)
+            if self.db is not None:
+                self._save_to_db(kind, key, entry)
+
+    def invalidate(self, kind, key):
+        """Drop a cached value, e.g. a stream URL the CDN rejected"""
+        with self.lock:
+            self.entries.pop((kind, key), None)
+            if self.db is not None:
+                self.db.execute("DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key))
+                self.db.commit()
+
+    def values(self, kind):
+        """Get every fresh value of a kind, least recently used first"""
+        now = time.time()
+        with self.lock:
+            if self.db is not None:
+                rows = self.db.execute(
+                    "SELECT value FROM cache WHERE kind = ? AND expires_at > ? ORDER BY accessed_at",
+                    (kind, now)
+                ).fetchall()
+                return [json.loads(row[0]) for row in rows]
+            return [
+                value for (entry_kind, _), (expires_at, value) in self.entries.items()
+                if entry_kind == kind and expires_at > now
+            ]
+
+    def _store(self, kind, key, entry):
+        """Insert into the in-memory LRU, evicting the least recently used entries"""
+        self.entries[(kind, key)] = entry
+        self.entries.move_to_end((kind, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _load_from_db(self, kind, key, now):
+        """Load a fresh entry from the SQLite store"""
+        row = self.db.execute(
+            "SELECT expires_at, value FROM cache WHERE kind = ? AND key = ? AND expires_at > ?",
+            (kind, key, now)
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.db.execute("UPDATE cache SET accessed_at = ? WHERE kind = ? AND key = ?", (now, kind, key))
+        self.db.commit()
+        return (row[0], json.loads(row[1]))
+
+    def _save_to_db(self, kind, key, entry):
+        """Write an entry through to the SQLite store"""
+        self.db.execute(
+            "INSERT OR REPLACE INTO cache (kind, key, expires_at, accessed_at, value) VALUES (?, ?, ?, ?, ?)",
+            (kind, key, entry[0], time.time(), json.dumps(entry[1]))
+        )
+        self.db.commit()
+
+        self.db_writes += 1
+        if self.db_writes % 500 == 0:
+            self._prune_db()
+
+    def _prune_db(self):
+        """Delete expired rows and cap the store to the least recently used limit"""
+        self.db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        self.db.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            "SELECT rowid FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries * 4,)
+        )
+        self.db.commit()
+
+    def stats(self):
+        """Get hit/miss counters and the number of entries per kind"""
+        with self.lock:
+            sizes = {kind: 0 for kind in self.ttls}
+            for kind, _ in self.entries:
+                sizes[kind] += 1
+            return {
+                kind: {"hits": self.hits[kind], "misses": self.misses[kind], "entries": sizes[kind]}
+                for kind in self.ttls
+            }
+
+# Create a global instance
+extraction_cache = ExtractionCache(CACHE_MAX_ENTRIES, CACHE_TTLS, CACHE_DB_PATH)
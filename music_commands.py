@@ -1,13 +1,22 @@
 """
 Music-related commands for the bot
 """
+import time
+from itertools import islice
 import discord
 from discord import app_commands
-from config import MAX_PLAYLIST_SIZE, YDL_BASE_OPTIONS
-from utils import is_url, is_playlist_url, find_best_match, get_search_prefix
-from music_queue import guild_queues
-from music_ytdlp import search_ytdlp_async, get_audio_url_from_track
-from music_player import play_next_song
+from config import MAX_PLAYLIST_SIZE, MAX_VIRTUAL_PLAYLIST_SIZE, YDL_BASE_OPTIONS, PLAYLIST_FIRST_CHUNK_SIZE
+from config import ENCODE_MIN_BITRATE, ENCODE_MAX_BITRATE
+from utils import is_url, is_playlist_url, get_search_prefix, format_duration
+from music_queue import guild_queues, PlaylistSegment
+from music_ytdlp import search_ytdlp_async, make_track, get_cached_metadata
+from music_scheduler import PRIORITY_INTERACTIVE
+from music_player import play_next_song, is_player_active, discard_prefetch, stop_playback
+from music_status import StatusMessage
+from music_metrics import metrics
+from music_ranking import pick_best_match
+from music_playlist import list_playlist_entries, UNAVAILABLE_TITLES
+from music_index import track_index
 
 def register_music_commands(bot):
     """Register all music-related commands with the bot"""
@@ -22,6 +31,7 @@ def register_music_commands(bot):
         app_commands.Choice(name="SoundCloud", value="soundcloud"),
     ])
     async def play(interaction: discord.Interaction, platform: str, query: str):
+        started_at = time.perf_counter()
         await interaction.response.defer()
 
         if interaction.user.voice is None:
@@ -34,10 +44,11 @@ def register_music_commands(bot):
             return
 
         voice_client = interaction.guild.voice_client
-        if voice_client is None:
-            voice_client = await voice_channel.connect()
-        elif voice_channel != voice_client.channel:
-            await voice_client.move_to(voice_channel)
+        with metrics.timer("play_phase_seconds", phase="voice_connect"):
+            if voice_client is None:
+                voice_client = await voice_channel.connect()
+            elif voice_channel != voice_client.channel:
+                await voice_client.move_to(voice_channel)
 
         guild_id = str(interaction.guild_id)
         guild_queues.reset_error_count(guild_id)
@@ -52,39 +63,63 @@ def register_music_commands(bot):
         tracks_added = 0
         
         # Handle URL vs search query differently
-        if is_url(query):
+        metadata = track_index.lookup(query)
+        if metadata is not None:
+            # A picked autocomplete suggestion, queued from what is known about it
+            request_kind = "suggestion"
+            await _add_indexed_track(interaction, metadata, guild_id)
+        elif is_url(query):
             # Process URL (playlist or single track)
-            await _process_url(interaction, query, guild_id, remaining_slots)
+            request_kind = "playlist" if is_playlist_url(query) else "url"
+            with metrics.timer("play_phase_seconds", phase=request_kind):
+                await _process_url(interaction, query, guild_id, remaining_slots, voice_client)
         else:
             # Search for track
+            request_kind = "search"
             await _search_and_add_track(interaction, platform, query, guild_id)
             
         # Start playback if not already playing
-        if not voice_client.is_playing() and not voice_client.is_paused():
-            await play_next_song(voice_client, guild_id, interaction.channel)
+        if not is_player_active(voice_client, guild_id):
+            with metrics.timer("play_phase_seconds", phase="playback_start"):
+                await play_next_song(voice_client, guild_id, interaction.channel)
+        metrics.observe("play_command_seconds", time.perf_counter() - started_at, kind=request_kind, platform=platform)
+
+    @play.autocomplete("query")
+    async def play_query_autocomplete(interaction: discord.Interaction, current: str):
+        """Suggest known tracks from the local index, without a network search"""
+        guild_id = str(interaction.guild_id)
+        return [
+            app_commands.Choice(name=track_index.describe(url), value=url)
+            for url in track_index.search(guild_id, current)
+        ]
+
+    async def _add_indexed_track(interaction, metadata, guild_id):
+        """Add a track from the local index, the stream URL is resolved at play time"""
+        track_record = make_track(metadata, interaction.user.id)
+        guild_queues.add_track(guild_id, track_record)
+        await StatusMessage(interaction).finish(f"➕ Added **{track_record.title}** to the queue!")
+        return 1
             
-    async def _process_url(interaction, query, guild_id, remaining_slots):
+    async def _process_url(interaction, query, guild_id, remaining_slots, voice_client):
         """Process a URL (playlist or single track)"""
         # Check if this is likely a playlist URL
         if is_playlist_url(query):
-            # Only fetch limited number of items (remaining queue slots, max 100)
-            ydl_options = YDL_BASE_OPTIONS.copy()
-            ydl_options["playlist_items"] = f"1-{remaining_slots}"
-            await interaction.followup.send(f"🎵 Detected playlist URL - limiting to first {remaining_slots} songs to fit queue limit.")
-        else:
-            ydl_options = YDL_BASE_OPTIONS.copy()
-            
-        await interaction.followup.send(f"🔍 Processing URL: `{query}`")
+            return await _stream_playlist(interaction, query, guild_id, remaining_slots, voice_client)
+
+        ydl_options = YDL_BASE_OPTIONS.copy()
+        status = StatusMessage(interaction)
+        await status.update(f"🔍 Processing URL: `{query}`")
         
         try:
             result = await search_ytdlp_async(query, ydl_options, guild_id)
             
             # If extraction completely failed
             if result is None:
-                await interaction.followup.send("❌ Failed to extract any information from this URL.")
+                await status.finish("❌ Failed to extract any information from this URL.")
                 return 0
                 
             is_playlist = False
+            playlist_title = None
             if "entries" in result:
                 tracks = result["entries"]
                 # Check if this is a playlist
@@ -95,9 +130,9 @@ def register_music_commands(bot):
                     
                     # Inform user about the playlist
                     if original_size > MAX_PLAYLIST_SIZE:
-                        await interaction.followup.send(f"📋 Found playlist: **{playlist_title}** ({original_size} tracks, limited to first {MAX_PLAYLIST_SIZE})")
+                        await status.update(f"📋 Found playlist: **{playlist_title}** ({original_size} tracks, limited to first {MAX_PLAYLIST_SIZE})")
                     else:
-                        await interaction.followup.send(f"📋 Found playlist: **{playlist_title}** ({len(tracks)} tracks)")
+                        await status.update(f"📋 Found playlist: **{playlist_title}** ({len(tracks)} tracks)")
             else:
                 tracks = [result]
 
@@ -106,24 +141,21 @@ def register_music_commands(bot):
             unavailable_count = 0
             
             for track in tracks:
-                if track is None:
+                if track is None or track.get("title") in UNAVAILABLE_TITLES:
                     unavailable_count += 1
                     continue
-                    
-                # Get audio URL
-                audio_url = get_audio_url_from_track(track)
-                if not audio_url:
+
+                track_record = make_track(track, interaction.user.id)
+                if not track_record.webpage_url and not track_record.stream_url:
                     unavailable_count += 1
                     continue
-                    
-                title = track.get("title", "Untitled")
                 
                 # Check if we've hit the queue limit
                 if guild_queues.queue_length(guild_id) >= MAX_PLAYLIST_SIZE:
-                    await interaction.followup.send(f"⚠️ Queue limit of {MAX_PLAYLIST_SIZE} songs reached. Added {tracks_added} songs.")
+                    await status.add_note(f"⚠️ Queue limit of {MAX_PLAYLIST_SIZE} songs reached.")
                     break
                 
-                guild_queues.add_track(guild_id, audio_url, title)
+                guild_queues.add_track(guild_id, track_record)
                 tracks_added += 1
             
             # Report unavailable videos
@@ -131,28 +163,88 @@ def register_music_commands(bot):
             if unavailable_count > 0 or error_count > 0:
                 total_errors = unavailable_count + error_count
                 if is_playlist:
-                    await interaction.followup.send(f"⚠️ {total_errors} video(s) in the playlist were unavailable or restricted and were skipped.")
+                    await status.add_note(f"⚠️ {total_errors} video(s) in the playlist were unavailable or restricted and were skipped.")
                 else:
-                    await interaction.followup.send(f"⚠️ {total_errors} video(s) were unavailable or restricted and were skipped.")
+                    await status.add_note(f"⚠️ {total_errors} video(s) were unavailable or restricted and were skipped.")
             
-            # Final status message
-            if tracks_added > 0:
-                await interaction.followup.send(f"➕ Added {tracks_added} track(s) to queue!")
+            # Final status, edited into the same message
+            if tracks_added > 0 and is_playlist:
+                await status.finish(f"➕ Added {tracks_added} track(s) from **{playlist_title}** to queue!")
+            elif tracks_added > 0:
+                await status.finish(f"➕ Added {tracks_added} track(s) to queue!")
             else:
-                await interaction.followup.send("❌ No playable tracks found! The videos might be unavailable, age-restricted, or region-locked.")
+                await status.finish("❌ No playable tracks found! The videos might be unavailable, age-restricted, or region-locked.")
                 
             return tracks_added
                 
         except Exception as e:
-            await interaction.followup.send(f"❌ Error processing request: {str(e)}")
+            await status.finish(f"❌ Error processing request: {str(e)}")
             return 0
             
+    async def _stream_playlist(interaction, query, guild_id, remaining_slots, voice_client):
+        """Queue a playlist, listing the first entries now and the rest as playback approaches"""
+        status = StatusMessage(interaction)
+        await status.update("🎵 Detected playlist URL - listing the first songs...")
+
+        try:
+            # Someone is waiting on the first chunk, later ones are paged in by the player
+            end = min(PLAYLIST_FIRST_CHUNK_SIZE, remaining_slots)
+            result, tracks, unavailable_count = await list_playlist_entries(
+                query, 1, end, guild_id, interaction.user.id, PRIORITY_INTERACTIVE
+            )
+            error_count = guild_queues.get_error_count(guild_id)
+            if result is None:
+                await status.finish("❌ Failed to extract any information from this URL.")
+                return 0
+
+            playlist_title = result.get("title", "Unknown Playlist")
+            # Lazy listings like YouTube mixes have no count, they run until a listing comes up short
+            playlist_count = result.get("playlist_count")
+            playlist_size = min(playlist_count, MAX_VIRTUAL_PLAYLIST_SIZE) if playlist_count else None
+            has_more = end < playlist_size if playlist_size else len(result.get("entries") or ()) >= end
+            for track_record in tracks:
+                guild_queues.add_track(guild_id, track_record)
+            tracks_added = len(tracks)
+
+            # The rest of the playlist takes one queue slot until it is reached
+            queue_full = guild_queues.queue_length(guild_id) >= MAX_PLAYLIST_SIZE
+            segment = None
+            if has_more and not queue_full:
+                segment = PlaylistSegment(query, playlist_title, end + 1, playlist_size, interaction.user.id)
+                guild_queues.add_track(guild_id, segment)
+                tracks_added += segment.count or 0
+
+            # Start playing as soon as the first entries are queued
+            if (tracks_added > 0 or segment is not None) and not is_player_active(voice_client, guild_id):
+                await play_next_song(voice_client, guild_id, interaction.channel)
+
+            # Final status, edited into the same message
+            if has_more and queue_full:
+                await status.add_note(f"⚠️ Queue limit of {MAX_PLAYLIST_SIZE} songs reached.")
+            if (playlist_count or 0) > MAX_VIRTUAL_PLAYLIST_SIZE:
+                await status.add_note(f"⚠️ Playlist limited to its first {MAX_VIRTUAL_PLAYLIST_SIZE} songs.")
+            total_errors = unavailable_count + error_count
+            if total_errors > 0:
+                await status.add_note(f"⚠️ {total_errors} video(s) in the playlist were unavailable or restricted and were skipped.")
+            if segment is not None and segment.end is None:
+                await status.finish(f"➕ Added {tracks_added} track(s) and the rest of **{playlist_title}** to queue!")
+            elif tracks_added > 0:
+                await status.finish(f"➕ Added {tracks_added} track(s) from **{playlist_title}** to queue!")
+            else:
+                await status.finish("❌ No playable tracks found! The videos might be unavailable, age-restricted, or region-locked.")
+            return tracks_added
+
+        except Exception as e:
+            await status.finish(f"❌ Error processing request: {str(e)}")
+            return 0
+
     async def _search_and_add_track(interaction, platform, query, guild_id):
         """Search for a track and add it to the queue"""
         search_prefix = get_search_prefix(platform)
         search_query = f"{search_prefix}{query}"
         
-        await interaction.followup.send(f"🔍 Searching on **{platform}** for: `{query}`")
+        status = StatusMessage(interaction)
+        await status.update(f"🔍 Searching on **{platform}** for: `{query}`")
         
         # Phase 1: Get basic metadata with extract_flat
         flat_options = YDL_BASE_OPTIONS.copy()
@@ -160,19 +252,20 @@ def register_music_commands(bot):
         
         try:
             # Get basic metadata first
-            basic_results = await search_ytdlp_async(search_query, flat_options, guild_id)
+            with metrics.timer("play_phase_seconds", phase="flat_search"):
+                basic_results = await search_ytdlp_async(search_query, flat_options, guild_id)
             
             if basic_results is None or "entries" not in basic_results or not basic_results["entries"]:
-                await interaction.followup.send("❌ No results found!")
+                await status.finish("❌ No results found!")
                 return 0
                 
-            # Find best match based on titles
+            # Rank the results on title, uploader, duration and views
             valid_entries = [entry for entry in basic_results["entries"] if entry is not None]
             if not valid_entries:
-                await interaction.followup.send("❌ No valid results found!")
+                await status.finish("❌ No valid results found!")
                 return 0
                 
-            best_match = find_best_match(valid_entries, query)
+            best_match = pick_best_match(valid_entries, query)
             
             # Phase 2: Download complete info only for the best match
             full_options = YDL_BASE_OPTIONS.copy()
@@ -189,32 +282,41 @@ def register_music_commands(bot):
                     best_url = best_match.get("webpage_url", best_match.get("id", ""))
             
             if not best_url:
-                await interaction.followup.send("❌ Could not determine URL for the best match.")
+                await status.finish("❌ Could not determine URL for the best match.")
                 return 0
                 
-            await interaction.followup.send(f"✅ Found best match: **{best_match.get('title', 'Unknown')}**")
+            await status.update(f"✅ Found best match: **{best_match.get('title', 'Unknown')}**")
             
+            # Known tracks skip the full extraction, the stream URL is resolved at play time
+            metadata = get_cached_metadata(best_match)
+            if metadata is not None:
+                track_record = make_track(metadata, interaction.user.id)
+                guild_queues.add_track(guild_id, track_record)
+                await status.finish(f"➕ Added **{track_record.title}** to the queue!")
+                return 1
+
             # Get full details for best match
-            full_result = await search_ytdlp_async(best_url, full_options, guild_id)
+            with metrics.timer("play_phase_seconds", phase="full_extraction"):
+                full_result = await search_ytdlp_async(best_url, full_options, guild_id)
             
             if full_result is None:
-                await interaction.followup.send("❌ Failed to extract complete information for the selected track.")
+                await status.finish("❌ Failed to extract complete information for the selected track.")
                 return 0
                 
-            # Get audio URL
-            audio_url = get_audio_url_from_track(full_result)
-            if not audio_url:
-                await interaction.followup.send("❌ Could not extract audio URL from the selected track.")
+            # Keep the resolved stream URL, it is reused while it stays fresh
+            track_record = make_track(full_result, interaction.user.id)
+            if not track_record.stream_url:
+                await status.finish("❌ Could not extract audio URL from the selected track.")
                 return 0
                 
-            title = full_result.get("title", "Untitled")
-            guild_queues.add_track(guild_id, audio_url, title)
+            title = track_record.title
+            guild_queues.add_track(guild_id, track_record)
             
-            await interaction.followup.send(f"➕ Added **{title}** to the queue!")
+            await status.finish(f"➕ Added **{title}** to the queue!")
             return 1
             
         except Exception as e:
-            await interaction.followup.send(f"❌ Error during search: {str(e)}")
+            await status.finish(f"❌ Error during search: {str(e)}")
             return 0
 
     # Queue control commands
@@ -236,6 +338,65 @@ def register_music_commands(bot):
         guild_queues.set_loop_status(guild_id, "none")
         await interaction.response.send_message("⏹️ Looping disabled.")
 
+    @bot.tree.command(name="remove", description="Remove a song from the queue.")
+    @app_commands.describe(position="Position of the song as shown in /queue")
+    async def remove(interaction: discord.Interaction, position: int):
+        guild_id = str(interaction.guild_id)
+
+        if not 1 <= position < guild_queues.queue_length(guild_id):
+            await interaction.response.send_message("❌ No song at that position! Use /skip for the current song.")
+            return
+
+        track = guild_queues.remove_track(guild_id, position)
+        if isinstance(track, PlaylistSegment):
+            remaining = f"the remaining {track.count} songs" if track.count is not None else "the rest"
+            await interaction.response.send_message(f"🗑️ Removed {remaining} of **{track.title}** from the queue.")
+            return
+        await interaction.response.send_message(f"🗑️ Removed **{track.title}** from the queue.")
+
+    @bot.tree.command(name="move", description="Move a song to another position in the queue.")
+    @app_commands.describe(
+        position="Position of the song as shown in /queue",
+        new_position="Position to move the song to"
+    )
+    async def move(interaction: discord.Interaction, position: int, new_position: int):
+        guild_id = str(interaction.guild_id)
+        length = guild_queues.queue_length(guild_id)
+
+        if not 1 <= position < length or not 1 <= new_position < length:
+            await interaction.response.send_message("❌ No song at that position! The current song can't be moved.")
+            return
+
+        track = guild_queues.move_track(guild_id, position, new_position)
+        await interaction.response.send_message(f"↕️ Moved **{track.title}** to position {new_position}.")
+
+    @bot.tree.command(name="shuffle", description="Shuffle the upcoming songs in the queue.")
+    async def shuffle(interaction: discord.Interaction):
+        guild_id = str(interaction.guild_id)
+
+        if guild_queues.queue_length(guild_id) < 3:
+            await interaction.response.send_message("Not enough songs in the queue to shuffle!")
+            return
+
+        guild_queues.shuffle_queue(guild_id)
+        await interaction.response.send_message("🔀 Shuffled the queue!")
+
+    @bot.tree.command(name="bitrate", description="Set the audio bitrate, or 0 to follow the voice channel.")
+    @app_commands.describe(kbps=f"Bitrate in kbps ({ENCODE_MIN_BITRATE}-{ENCODE_MAX_BITRATE}), 0 for automatic")
+    async def bitrate(interaction: discord.Interaction, kbps: int):
+        guild_id = str(interaction.guild_id)
+
+        if kbps == 0:
+            guild_queues.set_bitrate_override(guild_id, None)
+            await interaction.response.send_message("🎚️ Bitrate follows the voice channel from the next song.")
+            return
+        if not ENCODE_MIN_BITRATE <= kbps <= ENCODE_MAX_BITRATE:
+            await interaction.response.send_message(f"❌ Bitrate must be between {ENCODE_MIN_BITRATE} and {ENCODE_MAX_BITRATE} kbps!")
+            return
+
+        guild_queues.set_bitrate_override(guild_id, kbps)
+        await interaction.response.send_message(f"🎚️ Bitrate set to {kbps} kbps from the next song.")
+
     # Playback control commands
     @bot.tree.command(name="leave", description="Disconnect the bot from voice channel and clear the queue.")
     async def leave(interaction: discord.Interaction):
@@ -248,10 +409,11 @@ def register_music_commands(bot):
             
         # Clear the queue for this guild
         guild_queues.clear_queue(guild_id)
+        discard_prefetch(guild_id)
+        guild_queues.clear_channels(guild_id)
             
         # Stop any current playback
-        if voice_client.is_playing() or voice_client.is_paused():
-            voice_client.stop()
+        stop_playback(voice_client, guild_id)
             
         # Disconnect from the voice channel
         await voice_client.disconnect()
@@ -266,7 +428,8 @@ def register_music_commands(bot):
             await interaction.response.send_message("Nothing is playing to skip!")
             return
 
-        voice_client.stop()
+        discard_prefetch(guild_id)
+        stop_playback(voice_client, guild_id)
         await interaction.response.send_message("⏭️ Skipped current song!")
 
     @bot.tree.command(name="stop", description="Stop playback and clear the queue.")
@@ -279,9 +442,10 @@ def register_music_commands(bot):
             return
 
         guild_queues.clear_queue(guild_id)
+        discard_prefetch(guild_id)
         
         if voice_client.is_playing() or voice_client.is_paused():
-            voice_client.stop()
+            stop_playback(voice_client, guild_id)
             await interaction.response.send_message("⏹️ Playback stopped and queue cleared!")
         else:
             await interaction.response.send_message("Nothing is playing!")
@@ -317,17 +481,26 @@ def register_music_commands(bot):
             return
             
         queue_list = []
-        queue = guild_queues.get_queue(guild_id)
+        queue = guild_queues.peek_queue(guild_id)
         
-        for i, (_, title) in enumerate(queue):
+        for i, track in enumerate(islice(queue, 15)):
             prefix = "🎵 Now Playing: " if i == 0 else f"{i}. "
-            queue_list.append(f"{prefix}{title}")
+            if isinstance(track, PlaylistSegment):
+                more = f"{track.count} more songs" if track.count is not None else "more songs"
+                queue_list.append(f"{prefix}📋 {more} from **{track.title}**")
+                continue
+            uploader = f" - {track.uploader}" if track.uploader else ""
+            queue_list.append(f"{prefix}{track.title}{uploader} `[{format_duration(track.duration)}]`")
         
         # Create embed with pagination if needed
-        embed = discord.Embed(title="Current Queue", description="\n".join(queue_list[:15]), color=0x3498db)
+        embed = discord.Embed(title="Current Queue", description="\n".join(queue_list), color=0x3498db)
         
-        if len(queue_list) > 15:
-            embed.set_footer(text=f"And {len(queue_list) - 15} more songs...")
+        total_songs = guild_queues.entry_count(guild_id)
+        shown_songs = sum((item.count or 0) if isinstance(item, PlaylistSegment) else 1 for item in islice(queue, 15))
+        # Playlists of unknown length make the total a lower bound
+        open_ended = any(isinstance(item, PlaylistSegment) and item.end is None for item in queue)
+        if total_songs > shown_songs:
+            embed.set_footer(text=f"And {total_songs - shown_songs} more songs...")
         
         loop_status = guild_queues.get_loop_status(guild_id)
         if loop_status == "one":
@@ -337,5 +510,7 @@ def register_music_commands(bot):
         
         # Add queue limit info
         embed.add_field(name="Queue Limit", value=f"{guild_queues.queue_length(guild_id)}/{MAX_PLAYLIST_SIZE} songs", inline=True)
+        embed.add_field(name="Total Songs", value=f"{total_songs}+" if open_ended else str(total_songs), inline=True)
+        embed.add_field(name="Total Length", value=format_duration(guild_queues.total_duration(guild_id)), inline=True)
         
         await interaction.response.send_message(embed=embed)
\ No newline at end of file
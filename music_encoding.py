@@ -0,0 +1,46 @@
+"""
+Channel-aware Opus encoder settings that step down when the host is busy
+"""
+import os
+from collections import namedtuple
+from config import FFMPEG_BITRATE, ENCODE_MIN_BITRATE, ENCODE_MAX_BITRATE, ENCODE_COMPLEXITY, ENCODE_LOAD_STEPS
+from music_queue import guild_queues
+
+# Encoder bitrate in kbps and libopus compression level
+Encoding = namedtuple("Encoding", ("bitrate", "complexity"))
+
+DEFAULT_ENCODING = Encoding(FFMPEG_BITRATE, ENCODE_COMPLEXITY)
+
+# libopus complexity for streams started while every transcode slot is taken
+DEGRADED_COMPLEXITY = 0
+
+def get_host_load():
+    """Get the one minute load average per CPU core"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return 0.0
+
+def select_encoding(voice_client, guild_id):
+    """Pick the encoder settings for a guild from its override or channel, and the host load
+
+    Channels report the bitrate their listeners' clients use, encoding above it is
+    wasted CPU and bandwidth. When the host is saturated every new stream is encoded
+    cheaper, an override keeps its bitrate and only gives up complexity.
+    """
+    bitrate = guild_queues.get_bitrate_override(guild_id)
+    override = bitrate is not None
+    if not override:
+        channel_bitrate = getattr(voice_client.channel, "bitrate", None)
+        bitrate = channel_bitrate // 1000 if channel_bitrate else FFMPEG_BITRATE
+
+    complexity = ENCODE_COMPLEXITY
+    load = get_host_load()
+    for threshold, bitrate_factor, step_complexity in ENCODE_LOAD_STEPS:
+        if load >= threshold:
+            complexity = min(complexity, step_complexity)
+            if not override:
+                bitrate = int(bitrate * bitrate_factor)
+            break
+
+    return Encoding(max(ENCODE_MIN_BITRATE, min(bitrate, ENCODE_MAX_BITRATE)), complexity)
@@ -0,0 +1,42 @@
+"""
+Reclaims voice connections and memory held by idle guilds
+"""
+import asyncio
+from config import IDLE_DISCONNECT_SECONDS, IDLE_EVICT_SECONDS
+from music_queue import guild_queues
+from music_player import is_player_active, discard_prefetch
+from music_index import track_index
+
+async def reap_idle_guilds(bot):
+    """Leave voice in guilds that stopped playing and drop long-idle guilds from memory"""
+    idle_voice_clients = {}
+    for voice_client in bot.voice_clients:
+        guild_id = str(voice_client.guild.id)
+        if is_player_active(voice_client, guild_id):
+            guild_queues.touch(guild_id)
+        else:
+            idle_voice_clients[guild_id] = voice_client
+
+    for guild_id in guild_queues.idle_guilds(IDLE_DISCONNECT_SECONDS):
+        voice_client = idle_voice_clients.pop(guild_id, None)
+        if voice_client is None:
+            continue
+        discard_prefetch(guild_id)
+        guild_queues.clear_channels(guild_id)
+        try:
+            await voice_client.disconnect()
+        except Exception as e:
+            print(f"Could not leave idle voice channel: {str(e)}")
+
+    for guild_id in guild_queues.idle_guilds(IDLE_EVICT_SECONDS):
+        if guild_id not in idle_voice_clients and guild_queues.evict(guild_id):
+            track_index.forget_guild(guild_id)
+
+async def run_idle_reaper(bot, interval):
+    """Reap idle guilds every interval seconds, until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reap_idle_guilds(bot)
+        except Exception as e:
+            print(f"Idle reaper error: {str(e)}")
@@ -0,0 +1,133 @@
+"""
+In-memory search index over known tracks, for /play autocomplete without touching yt-dlp
+"""
+import heapq
+import math
+from collections import OrderedDict, Counter
+from config import AUTOCOMPLETE_MAX_TRACKS, AUTOCOMPLETE_GUILD_HISTORY, AUTOCOMPLETE_MAX_SUGGESTIONS
+from music_ranking import tokenize
+from utils import format_duration
+
+# Discord caps autocomplete choice names and values at 100 characters
+CHOICE_MAX_LENGTH = 100
+
+def _word_grams(word):
+    """Get the grams a word is posted under, its first letter and every trigram"""
+    padded = " " + word
+    return {padded[:2]} | {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrackIndex:
+    """Trigram index over the titles and uploaders of tracks played or extracted before
+
+    Every word is posted under its trigrams, padded with a leading space so the first
+    one only matches at the start of a word, plus its first letter for one-letter
+    queries. A lookup intersects the postings of the query's grams and then checks that
+    every query word starts a word of the track. Guilds keep a play history that ranks
+    their own tracks first, until the guild is evicted from memory.
+    """
+    def __init__(self, max_tracks, guild_history):
+        self.max_tracks = max_tracks
+        self.guild_history = guild_history
+        self.tracks = OrderedDict()  # {webpage_url: metadata}, least recently seen first
+        self.words = {}  # {webpage_url: frozenset of words}
+        self.postings = {}  # {gram: set of webpage_urls}
+        self.plays = Counter()  # {webpage_url: plays in every guild}
+        self.history = {}  # {guild_id: OrderedDict({webpage_url: plays})}
+
+    def add(self, metadata):
+        """Index a track from its cached metadata, refreshing it if it is known"""
+        url = metadata.get("webpage_url")
+        if not url or len(url) > CHOICE_MAX_LENGTH or not metadata.get("title"):
+            return
+
+        if url in self.tracks:
+            self.tracks[url] = metadata
+            self.tracks.move_to_end(url)
+            return
+
+        words = tokenize(metadata["title"]) | tokenize(metadata.get("uploader") or metadata.get("channel") or "")
+        self.tracks[url] = metadata
+        self.words[url] = words
+        for word in words:
+            for gram in _word_grams(word):
+                self.postings.setdefault(gram, set()).add(url)
+
+        while len(self.tracks) > self.max_tracks:
+            self._forget(next(iter(self.tracks)))
+
+    def load(self, entries):
+        """Index cached metadata, oldest first"""
+        for metadata in entries:
+            self.add(metadata)
+
+    def _forget(self, url):
+        """Drop a track from the index"""
+        del self.tracks[url]
+        self.plays.pop(url, None)
+        for word in self.words.pop(url):
+            for gram in _word_grams(word):
+                posting = self.postings.get(gram)
+                if posting is not None:
+                    posting.discard(url)
+                    if not posting:
+                        del self.postings[gram]
+
+    def record_play(self, guild_id, track):
+        """Count a track played in a guild"""
+        if not track.webpage_url:
+            return
+        self.add({
+            "id": track.id, "webpage_url": track.webpage_url, "title": track.title,
+            "uploader": track.uploader, "duration": track.duration,
+        })
+        self.plays[track.webpage_url] += 1
+
+        history = self.history.setdefault(guild_id, OrderedDict())
+        history[track.webpage_url] = history.get(track.webpage_url, 0) + 1
+        history.move_to_end(track.webpage_url)
+        while len(history) > self.guild_history:
+            history.popitem(last=False)
+
+    def forget_guild(self, guild_id):
+        """Drop a guild's play history, e.g. when the guild is evicted from memory"""
+        self.history.pop(guild_id, None)
+
+    def lookup(self, url):
+        """Get the metadata of an indexed track, or None"""
+        return self.tracks.get(url)
+
+    def search(self, guild_id, query, limit=AUTOCOMPLETE_MAX_SUGGESTIONS):
+        """Get the webpage URLs of the best matches for a partly typed query"""
+        history = self.history.get(guild_id, {})
+        query_words = tokenize(query)
+        if not query_words:
+            # Nothing typed yet, offer the guild's most played tracks
+            recent = [url for url in reversed(history) if url in self.tracks]
+            return sorted(recent, key=lambda url: -history[url])[:limit]
+
+        grams = set().union(*(_word_grams(word) for word in query_words))
+        postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+
+        matches = []
+        for url in candidates:
+            words = self.words[url]
+            if all(any(word.startswith(query_word) for word in words) for query_word in query_words):
+                score = 2 * math.log1p(history.get(url, 0)) + math.log1p(self.plays[url])
+                if query_words <= words:
+                    score += 1  # Whole words beat words still being typed
+                matches.append((score, url))
+        return [url for _, url in heapq.nlargest(limit, matches)]
+
+    def describe(self, url):
+        """Format an indexed track as an autocomplete label"""
+        metadata = self.tracks[url]
+        label = metadata["title"]
+        uploader = metadata.get("uploader") or metadata.get("channel")
+        if uploader:
+            label += f" - {uploader}"
+        suffix = f" [{format_duration(metadata['duration'])}]" if metadata.get("duration") else ""
+        return label[:CHOICE_MAX_LENGTH - len(suffix)] + suffix
+
+# Create a global instance
+track_index = TrackIndex(AUTOCOMPLETE_MAX_TRACKS, AUTOCOMPLETE_GUILD_HISTORY)
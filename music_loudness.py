@@ -0,0 +1,209 @@
+"""
+Background loudness analysis, so later plays of a track get a single-pass gain correction
+"""
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from config import LOUDNESS_DB_PATH, LOUDNESS_MEMORY_ENTRIES
+from config import FFMPEG_OPTIONS, LOUDNESS_ENABLED, LOUDNESS_TARGET, LOUDNESS_MAX_TRUE_PEAK, LOUDNESS_MAX_GAIN
+from config import LOUDNESS_MIN_GAIN, LOUDNESS_ANALYSIS_SECONDS, LOUDNESS_ANALYSIS_TIMEOUT
+from config import LOUDNESS_ANALYSIS_INTERVAL, LOUDNESS_MAX_LOAD, LOUDNESS_QUEUE_SIZE
+from music_encoding import get_host_load
+from music_metrics import metrics
+from music_supervisor import ffmpeg_supervisor
+from utils import get_platform_from_url
+
+def compute_gain(integrated, true_peak):
+    """Get the gain in dB that brings a track to the target without clipping, or None for none
+
+    Gains are rounded to half a dB so replays share audio cache entries and tiny
+    corrections don't cost a re-encode.
+    """
+    if not math.isfinite(integrated) or not math.isfinite(true_peak):
+        return None  # Silence
+    gain = min(LOUDNESS_TARGET - integrated, LOUDNESS_MAX_TRUE_PEAK - true_peak)
+    gain = round(max(-LOUDNESS_MAX_GAIN, min(gain, LOUDNESS_MAX_GAIN)) * 2) / 2
+    return gain if abs(gain) >= LOUDNESS_MIN_GAIN else None
+
+def parse_loudnorm_output(stderr):
+    """Get the integrated loudness and true peak from loudnorm's JSON summary, or None"""
+    start = stderr.rfind("{")
+    end = stderr.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        summary = json.loads(stderr[start:end + 1])
+        return float(summary["input_i"]), float(summary["input_tp"])
+    except (ValueError, KeyError):
+        return None
+
+def get_loudness_key(track):
+    """Get the platform-qualified id a track's loudness is stored under, or None"""
+    if not track.id:
+        return None
+    return f"{get_platform_from_url(track.webpage_url or '') or 'other'}:{track.id}"
+
+class LoudnessStore:
+    """Loudness measurements in SQLite, with the most recently used ones held in memory
+
+    A measurement depends only on the audio, so it is kept until the database is
+    deleted. Without a database path measurements only last until the bot restarts.
+    The database is opened on first use.
+    """
+    def __init__(self, db_path, memory_entries):
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.entries = OrderedDict()  # {key: (integrated, true_peak)}
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _connect(self):
+        """Get the database connection, opening it on first use, or None without a path"""
+        if self.db is None and self.db_path:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS loudness ("
+                "key TEXT PRIMARY KEY, integrated REAL, true_peak REAL, measured_at REAL)"
+            )
+            self.db.commit()
+        return self.db
+
+    def get(self, key):
+        """Get the (integrated, true_peak) measured for a key, or None"""
+        with self.lock:
+            measurement = self.entries.get(key)
+            db = self._connect() if measurement is None else None
+            if db is not None:
+                row = db.execute("SELECT integrated, true_peak FROM loudness WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    measurement = (row[0], row[1])
+                    self._remember(key, measurement)
+            elif measurement is not None:
+                self.entries.move_to_end(key)
+            return measurement
+
+    def set(self, key, integrated, true_peak):
+        """Store a measurement"""
+        with self.lock:
+            self._remember(key, (integrated, true_peak))
+            db = self._connect()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO loudness (key, integrated, true_peak, measured_at) VALUES (?, ?, ?, ?)",
+                    (key, integrated, true_peak, time.time())
+                )
+                db.commit()
+
+    def _remember(self, key, measurement):
+        self.entries[key] = measurement
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.memory_entries:
+            self.entries.popitem(last=False)
+
+def _lower_priority():
+    """Run the analysis at the lowest CPU priority, in the ffmpeg child"""
+    os.nice(19)
+
+class LoudnessAnalyzer:
+    """Measures tracks one at a time in the background and caches their loudness
+
+    Tracks are queued when they first play. The worker runs one niced ffmpeg at a time,
+    spaces analyses out and waits while the host is busy, so live streams always come
+    first. Measurements are stored by platform-qualified track id.
+    """
+    def __init__(self, enabled, store):
+        self.enabled = enabled
+        self.store = store
+        self.pending = OrderedDict()  # {loudness key: (stream_url, title)}
+        self.wakeup = None  # Created in the bot's event loop
+        if enabled and not store.db_path:
+            print("Warning: LOUDNESS_DB_PATH is not set, loudness measurements are lost on restart")
+
+    def get_gain(self, track):
+        """Get the stored gain in dB for a track, or None"""
+        key = get_loudness_key(track) if self.enabled else None
+        measurement = self.store.get(key) if key else None
+        if measurement is None:
+            return None
+        return compute_gain(*measurement)
+
+    def schedule(self, track):
+        """Queue a playing track for analysis unless it was measured already"""
+        key = get_loudness_key(track) if self.enabled else None
+        if not key or not track.stream_url or key in self.pending:
+            return
+        if self.store.get(key) is not None:
+            return
+        self.pending[key] = (track.stream_url, track.title)
+        while len(self.pending) > LOUDNESS_QUEUE_SIZE:
+            self.pending.popitem(last=False)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self):
+        """Analyze queued tracks until cancelled"""
+        self.wakeup = asyncio.Event()
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            # Leave the CPU to live streams while the host is busy
+            while get_host_load() >= LOUDNESS_MAX_LOAD:
+                await asyncio.sleep(LOUDNESS_ANALYSIS_INTERVAL)
+
+            # Newest first, the track that just played is the likeliest to be replayed
+            key, (stream_url, title) = self.pending.popitem()
+            with metrics.timer("loudness_analysis_seconds"):
+                measurement = await self._analyze(stream_url, title)
+            metrics.inc("loudness_analyses_total", outcome="success" if measurement else "failure")
+            if measurement is not None:
+                self.store.set(key, *measurement)
+            await asyncio.sleep(LOUDNESS_ANALYSIS_INTERVAL)
+
+    async def _analyze(self, stream_url, title):
+        """Measure the start of a stream with ffmpeg's loudnorm, returning (LUFS, dBTP) or None"""
+        args = ["ffmpeg", "-nostdin", "-hide_banner", "-nostats"]
+        args += FFMPEG_OPTIONS["before_options"].split()
+        args += ["-t", str(LOUDNESS_ANALYSIS_SECONDS), "-i", stream_url, "-vn", "-threads", "1"]
+        args += ["-af", "loudnorm=print_format=json", "-f", "null", "-"]
+        try:
+            supervised = await ffmpeg_supervisor.spawn_analysis(
+                title,
+                args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                preexec_fn=_lower_priority if hasattr(os, "nice") else None,
+            )
+        except OSError as e:
+            print(f"Loudness analysis error for {title}: {str(e)}")
+            return None
+
+        process = supervised.process
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), LOUDNESS_ANALYSIS_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            print(f"Loudness analysis timed out for {title}")
+            return None
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        finally:
+            ffmpeg_supervisor.release(supervised)
+
+        measurement = parse_loudnorm_output(stderr.decode(errors="replace"))
+        if measurement is None:
+            print(f"Loudness analysis failed for {title}")
+        return measurement
+
+# Create a global instance
+loudness_analyzer = LoudnessAnalyzer(LOUDNESS_ENABLED, LoudnessStore(LOUDNESS_DB_PATH, LOUDNESS_MEMORY_ENTRIES))
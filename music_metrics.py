@@ -0,0 +1,170 @@
+"""
+Lightweight latency histograms, counters and gauges with a Prometheus text endpoint
+"""
+import asyncio
+import bisect
+import os
+import threading
+import time
+from contextlib import nullcontext
+from config import METRICS_ENABLED
+
+# Upper bounds in seconds, covering cache hits up to slow playlist extractions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts values above every bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class _Timer:
+    """Observes the seconds spent inside a with block"""
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+_DISABLED_TIMER = nullcontext()
+
+class MetricsRegistry:
+    """Process-wide metrics, every call is a no-op while disabled
+
+    Histograms and counters are updated from the event loop and from worker and audio
+    threads. Gauges are read from callbacks when the metrics are rendered, so keeping
+    them costs nothing between scrapes.
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.histograms = {}  # {(name, labels): Histogram}
+        self.counters = {}  # {(name, labels): value}
+        self.gauges = {}  # {name: callback returning a number or [(labels, number)]}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """Add a value, in seconds, to a latency histogram"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(DEFAULT_BUCKETS)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timer(self, name, **labels):
+        """Time a with block into a histogram"""
+        if not self.enabled:
+            return _DISABLED_TIMER
+        return _Timer(self, name, labels)
+
+    def gauge(self, name, callback):
+        """Register a gauge read from callback(), which returns a number or [(labels, number)]"""
+        self.gauges[name] = callback
+
+    def render(self):
+        """Format every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            snapshots = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in histograms]
+
+        seen = set()
+        for (name, labels), counts, total, count, buckets in snapshots:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, callback in sorted(self.gauges.items()):
+            try:
+                value = callback()
+            except Exception as e:
+                print(f"Metrics gauge {name} error: {str(e)}")
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            values = value if isinstance(value, list) else [({}, value)]
+            for labels, number in values:
+                lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {number}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Serve the metrics over plain HTTP on host:port, for a Prometheus scraper"""
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    async def dump_periodically(self, path, interval):
+        """Write the metrics to path every interval seconds, until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self._dump, path)
+
+    def _dump(self, path):
+        """Replace path with the current metrics"""
+        partial_path = path + ".tmp"
+        with open(partial_path, "w") as f:
+            f.write(self.render())
+        os.replace(partial_path, path)
+
+def _format_labels(labels):
+    """Format (name, value) pairs as a Prometheus label set"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+# Create a global instance
+metrics = MetricsRegistry(METRICS_ENABLED)
@@ -0,0 +1,169 @@
+"""
+SQLite persistence for guild queues and player state
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+from music_queue import queue_item_from_dict
+
+class QueueStore:
+    """Writes queue changes behind to SQLite in batched transactions
+
+    Every queue change becomes one small row operation, keyed by the track's sort key,
+    and is buffered until the next flush commits the whole batch at once. Loads read
+    through a connection of their own and never flush, WAL readers don't wait on writers.
+    """
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS guild_state ("
+            "guild_id TEXT PRIMARY KEY, loop_status TEXT, platform TEXT, "
+            "text_channel_id INTEGER, voice_channel_id INTEGER, position REAL, bitrate INTEGER)"
+        )
+        try:
+            # Databases written before the bitrate override existed
+            self.db.execute("ALTER TABLE guild_state ADD COLUMN bitrate INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS queue_tracks ("
+            "guild_id TEXT, sort_key REAL, data TEXT, PRIMARY KEY (guild_id, sort_key))"
+        )
+        self.db.commit()
+        self.reader = sqlite3.connect(db_path, check_same_thread=False)
+        self.pending = []  # [(guild_id, sql, params)] waiting for the next flush
+        self.lock = threading.Lock()  # Guards self.pending
+        self.db_lock = threading.Lock()  # Flushes run in an executor thread
+
+    def _queue(self, guild_id, sql, params):
+        with self.lock:
+            self.pending.append((guild_id, sql, params))
+
+    def has_pending(self, guild_id):
+        """Check if changes to a guild are still waiting to be flushed"""
+        with self.lock:
+            return any(pending_guild_id == guild_id for pending_guild_id, _, _ in self.pending)
+
+    def save_track(self, guild_id, track):
+        self._queue(
+            guild_id,
+            "INSERT OR REPLACE INTO queue_tracks (guild_id, sort_key, data) VALUES (?, ?, ?)",
+            (guild_id, track.sort_key, json.dumps(track.to_dict()))
+        )
+
+    def delete_track(self, guild_id, sort_key):
+        self._queue(guild_id, "DELETE FROM queue_tracks WHERE guild_id = ? AND sort_key = ?", (guild_id, sort_key))
+
+    def move_track(self, guild_id, old_key, new_key):
+        self._queue(
+            guild_id,
+            "UPDATE queue_tracks SET sort_key = ? WHERE guild_id = ? AND sort_key = ?",
+            (new_key, guild_id, old_key)
+        )
+
+    def clear_tracks(self, guild_id):
+        self._queue(guild_id, "DELETE FROM queue_tracks WHERE guild_id = ?", (guild_id,))
+
+    def replace_tracks(self, guild_id, tracks):
+        """Rewrite a guild's whole queue, for changes that reorder every track"""
+        self.clear_tracks(guild_id)
+        for track in tracks:
+            self.save_track(guild_id, track)
+
+    def save_state(self, guild_id, state):
+        self._queue(
+            guild_id,
+            "INSERT OR REPLACE INTO guild_state "
+            "(guild_id, loop_status, platform, text_channel_id, voice_channel_id, position, bitrate) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (guild_id, state["loop_status"], state["platform"], state["text_channel_id"],
+             state["voice_channel_id"], state["position"], state["bitrate"])
+        )
+
+    def delete_guild(self, guild_id):
+        """Forget everything stored for a guild"""
+        self.clear_tracks(guild_id)
+        self._queue(guild_id, "DELETE FROM guild_state WHERE guild_id = ?", (guild_id,))
+
+    def flush(self):
+        """Commit every buffered change in one transaction
+
+        The batch is taken and applied under db_lock, so batches commit in the order
+        they were taken. A failed batch is rolled back and put back in front of the
+        changes queued since, for the next flush to retry.
+        """
+        with self.db_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return
+
+            try:
+                with self.db:
+                    for _, sql, params in batch:
+                        self.db.execute(sql, params)
+            except sqlite3.Error:
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+
+    def load(self, guild_id=None):
+        """Load the stored queues and player state, for one guild or all of them
+
+        Changes still waiting for a flush aren't included, guilds with pending changes
+        are kept in memory until they are written.
+        """
+        where, params = ("WHERE guild_id = ?", (guild_id,)) if guild_id is not None else ("", ())
+        guilds = {}
+        # One read transaction, so both tables come from the same snapshot
+        self.reader.execute("BEGIN")
+        try:
+            for row in self.reader.execute(
+                "SELECT guild_id, loop_status, platform, text_channel_id, voice_channel_id, position, bitrate "
+                f"FROM guild_state {where}", params
+            ):
+                guilds[row[0]] = {
+                    "loop_status": row[1] or "none",
+                    "platform": row[2] or "youtube",
+                    "text_channel_id": row[3],
+                    "voice_channel_id": row[4],
+                    "position": row[5] or 0,
+                    "bitrate": row[6],
+                    "tracks": [],
+                }
+
+            for stored_guild_id, sort_key, data in self.reader.execute(
+                f"SELECT guild_id, sort_key, data FROM queue_tracks {where}", params
+            ):
+                track = queue_item_from_dict(json.loads(data))
+                track.sort_key = sort_key
+                state = guilds.setdefault(stored_guild_id, {
+                    "loop_status": "none", "platform": "youtube", "text_channel_id": None,
+                    "voice_channel_id": None, "position": 0, "bitrate": None, "tracks": [],
+                })
+                state["tracks"].append(track)
+        finally:
+            self.reader.rollback()
+        return guilds
+
+    async def run(self, interval, before_flush=None):
+        """Flush the buffered changes every interval seconds, until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if before_flush is not None:
+                before_flush()
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except sqlite3.Error as e:
+                # e.g. locked by another shard process, the batch is retried next time
+                print(f"Queue store flush error: {str(e)}")
+
+    def close(self):
+        """Flush the last changes and close the database"""
+        self.flush()
+        self.reader.close()
+        self.db.close()
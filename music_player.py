@@ -2,51 +2,312 @@
 Music player functionality
 """
 import asyncio
-import discord
-from config import FFMPEG_OPTIONS
-from music_queue import guild_queues
+import time
+from config import PREFETCH_LEAD_SECONDS, STREAM_RETRY_LIMIT, STREAM_RETRY_BACKOFF, STREAM_EARLY_END_TOLERANCE
+from music_queue import guild_queues, PlaylistSegment
+from music_ytdlp import resolve_stream_url, invalidate_stream_url
+from music_scheduler import PRIORITY_BULK
+from music_playlist import page_in_upcoming
+from music_source import create_audio_source, open_cached_audio, needs_transcode, TrackedSource
+from music_supervisor import ffmpeg_supervisor
+from music_status import now_playing_announcer
+from music_encoding import select_encoding, DEFAULT_ENCODING
+from music_metrics import metrics
+from music_index import track_index
+from music_loudness import loudness_analyzer
 
-async def play_next_song(voice_client, guild_id, channel):
-    """Play the next song in the queue"""
+# Guilds whose next track is being resolved but not yet handed to the voice client
+_starting_guilds = set()
+
+# Sources warmed up for the upcoming track {guild_id: (track, source)}
+_prefetched = {}
+_prefetch_tasks = {}  # {guild_id: asyncio.Task}
+
+# Sources handed to the voice clients, they know the playback position {guild_id: TrackedSource}
+_now_playing = {}
+
+# Guilds whose track is being stopped on purpose, e.g. by /skip, rather than by a stream failure
+_stopping = set()
+
+# When each guild's last track ended, to measure the gap before the next one starts
+_ended_at = {}  # {guild_id: time.perf_counter()}
+
+# Recovery attempts for a track whose stream failed mid-play {guild_id: (track, attempts)}
+_stream_retries = {}
+
+def is_player_active(voice_client, guild_id):
+    """Check if the guild is playing, paused or about to start a track"""
+    return voice_client.is_playing() or voice_client.is_paused() or guild_id in _starting_guilds
+
+def discard_prefetch(guild_id):
+    """Cancel any pending prefetch and kill the prefetched ffmpeg process"""
+    task = _prefetch_tasks.pop(guild_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+
+    prefetched = _prefetched.pop(guild_id, None)
+    if prefetched is not None:
+        prefetched[1].cleanup()
+
+def _take_prefetched(guild_id, track):
+    """Take the prefetched source if it was warmed up for this track"""
+    prefetched = _prefetched.pop(guild_id, None)
+    discard_prefetch(guild_id)
+    if prefetched is None:
+        return None
+
+    prefetched_track, source = prefetched
+    if prefetched_track is not track:
+        source.cleanup()
+        return None
+    return source
+
+def _schedule_prefetch(guild_id, current_track, start_offset=0, encoding=DEFAULT_ENCODING):
+    """Prefetch the next track shortly before the current one ends"""
+    discard_prefetch(guild_id)
+
+    duration = current_track.duration
+    delay = max(0, duration - start_offset - PREFETCH_LEAD_SECONDS) if duration else 0
+    _prefetch_tasks[guild_id] = asyncio.create_task(_prefetch_next(guild_id, delay, encoding))
+
+async def _prefetch_next(guild_id, delay, encoding=DEFAULT_ENCODING):
+    """Resolve the next track and spawn its ffmpeg process ahead of time"""
+    await asyncio.sleep(delay)
+
+    await page_in_upcoming(guild_id, PRIORITY_BULK)
+    track = guild_queues.get_next_track(guild_id)
+    if track is None or isinstance(track, PlaylistSegment):
+        return
+
+    try:
+        source = open_cached_audio(track)
+        if source is None:
+            audio_url = await resolve_stream_url(track, guild_id, PRIORITY_BULK)
+            if not audio_url:
+                return
+            # Prefetching doesn't take the last transcode slots, the track waits for one when it starts
+            if needs_transcode(track) and ffmpeg_supervisor.is_full():
+                return
+            source = create_audio_source(track, encoding=encoding)
+    except Exception as e:
+        print(f"Prefetch error: {str(e)}")
+        return
+
+    # Only keep the source if nothing discarded this prefetch while it was running
+    if _prefetch_tasks.get(guild_id) is not asyncio.current_task():
+        source.cleanup()
+        return
+    _prefetch_tasks.pop(guild_id, None)
+    _prefetched[guild_id] = (track, source)
+
+def stop_playback(voice_client, guild_id):
+    """Stop the current track on purpose, so its early end isn't taken for a stream failure"""
+    if voice_client.is_playing() or voice_client.is_paused():
+        _stopping.add(guild_id)
+        voice_client.stop()
+
+def _stream_failed(track, source, error):
+    """Check if playback ended because the stream failed rather than at the end of the track"""
+    if error is not None:
+        return True
+    # ffmpeg can exit cleanly when the CDN cuts the stream off, the position gives it away
+    return bool(track.duration) and source.position < track.duration - STREAM_EARLY_END_TOLERANCE
+
+async def _recover_stream(voice_client, guild_id, channel, track, position, error):
+    """Re-resolve a track whose stream failed mid-play and resume it where it stopped"""
+    retry = _stream_retries.get(guild_id)
+    attempt = retry[1] + 1 if retry is not None and retry[0] is track else 1
+    if attempt > STREAM_RETRY_LIMIT:
+        _stream_retries.pop(guild_id, None)
+        guild_queues.set_playback_position(guild_id, 0)
+        reason = str(error) if error is not None else "the stream ended early"
+        await channel.send(f"⚠️ Error playing **{track.title}**: {reason}. Skipping to next song.")
+        guild_queues.remove_current_track(guild_id)
+        await play_next_song(voice_client, guild_id, channel)
+        return
+
+    print(f"Stream failed at {position:.1f}s, retrying (attempt {attempt}/{STREAM_RETRY_LIMIT}): {error}")
+    _stream_retries[guild_id] = (track, attempt)
+    guild_queues.set_playback_position(guild_id, position)
+
+    # Hold the player during the backoff so /play doesn't start another track meanwhile
+    _starting_guilds.add(guild_id)
+    try:
+        await asyncio.sleep(STREAM_RETRY_BACKOFF * 2 ** (attempt - 1))
+        invalidate_stream_url(track)
+    finally:
+        _starting_guilds.discard(guild_id)
+
+    if not voice_client.is_connected():
+        _stream_retries.pop(guild_id, None)
+        return
+    if guild_queues.get_current_track(guild_id) is not track:
+        # The queue was stopped or cleared during the backoff
+        _stream_retries.pop(guild_id, None)
+        await play_next_song(voice_client, guild_id, channel)
+        return
+    await play_next_song(voice_client, guild_id, channel, position)
+
+async def _advance_queue(voice_client, guild_id, channel, track, error):
+    """Take a finished track off the queue, honouring the loop mode, and play the next one"""
+    guild_queues.set_playback_position(guild_id, 0)
+
+    # Leave the queue alone if it was stopped or cleared since the track ended
+    if guild_queues.get_current_track(guild_id) is track:
+        loop_mode = guild_queues.get_loop_status(guild_id)
+        if error:
+            # Don't loop on error
+            guild_queues.remove_current_track(guild_id)
+        elif loop_mode == "all":
+            guild_queues.rotate_queue(guild_id)
+        elif loop_mode != "one":
+            guild_queues.remove_current_track(guild_id)
+
+    await play_next_song(voice_client, guild_id, channel)
+
+def record_playback_positions():
+    """Record how far into the current track every playing guild is"""
+    for guild_id, source in list(_now_playing.items()):
+        guild_queues.set_playback_position(guild_id, round(source.position, 1))
+
+async def resume_playback(bot):
+    """Rejoin the voice channels recorded before a restart and resume where playback stopped"""
+    for guild_id, (text_channel_id, voice_channel_id) in list(guild_queues.channels.items()):
+        voice_channel = bot.get_channel(voice_channel_id)
+        text_channel = bot.get_channel(text_channel_id)
+        if voice_channel is None or text_channel is None or guild_queues.queue_length(guild_id) == 0:
+            guild_queues.clear_channels(guild_id)
+            continue
+
+        try:
+            voice_client = voice_channel.guild.voice_client or await voice_channel.connect()
+        except Exception as e:
+            print(f"Could not rejoin voice channel {voice_channel_id}: {str(e)}")
+            guild_queues.clear_channels(guild_id)
+            continue
+
+        await play_next_song(voice_client, guild_id, text_channel, guild_queues.get_playback_position(guild_id))
+
+async def play_next_song(voice_client, guild_id, channel, start_offset=0):
+    """Play the next song in the queue, optionally starting start_offset seconds in"""
     if not voice_client or not voice_client.is_connected():
+        discard_prefetch(guild_id)
         return
-        
+
+    if guild_id in _starting_guilds:
+        return
+
+    # List the playlist entries about to play before taking the current track
+    if isinstance(guild_queues.get_current_track(guild_id), PlaylistSegment):
+        _starting_guilds.add(guild_id)
+        try:
+            await page_in_upcoming(guild_id)
+        finally:
+            _starting_guilds.discard(guild_id)
+        if not voice_client.is_connected():
+            return
+
     if guild_queues.queue_length(guild_id) == 0:
+        discard_prefetch(guild_id)
+        _ended_at.pop(guild_id, None)
+        guild_queues.clear_channels(guild_id)
         await voice_client.disconnect()
         return
 
-    audio_url, title = guild_queues.get_current_track(guild_id)
+    track = guild_queues.get_current_track(guild_id)
+    title = track.title
+    started_at = time.perf_counter()
 
+    _starting_guilds.add(guild_id)
     try:
-        source = discord.FFmpegOpusAudio(audio_url, **FFMPEG_OPTIONS)
-        
+        # Prefetched sources always start at the beginning of the track
+        source = _take_prefetched(guild_id, track) if start_offset == 0 else None
+        source_kind = "prefetched"
+        if source is None:
+            source = open_cached_audio(track, start_offset)
+            source_kind = "cached" if source is not None else "resolved"
+        degraded = False
+
+        if source_kind == "resolved":
+            # Resolve the stream URL just in time, signed URLs expire after a few hours
+            with metrics.timer("track_start_phase_seconds", phase="resolve"):
+                audio_url = await resolve_stream_url(track, guild_id)
+            if not audio_url:
+                raise RuntimeError("could not resolve a stream URL")
+            title = track.title
+
+            # Wait in line for a transcode slot, past the timeout the track starts the cheap way
+            if needs_transcode(track):
+                with metrics.timer("track_start_phase_seconds", phase="admission"):
+                    degraded = not await ffmpeg_supervisor.admit()
+
+            # The queue may have been skipped, stopped or cleared while resolving
+            if guild_queues.get_current_track(guild_id) is not track or not voice_client.is_connected():
+                _starting_guilds.discard(guild_id)
+                await play_next_song(voice_client, guild_id, channel)
+                return
+
+        encoding = select_encoding(voice_client, guild_id)
+        if source is None:
+            with metrics.timer("track_start_phase_seconds", phase="create_source"):
+                source = create_audio_source(track, start_offset, encoding, degraded)
+        source = TrackedSource(source, start_offset)
+
         def after_play(error):
-            loop_mode = guild_queues.get_loop_status(guild_id)
-            
+            if _now_playing.get(guild_id) is source:
+                del _now_playing[guild_id]
+            _ended_at[guild_id] = time.perf_counter()
+            stopped = guild_id in _stopping
+            _stopping.discard(guild_id)
+
+            if not stopped and _stream_failed(track, source, error):
+                metrics.inc("tracks_ended_total", outcome="failed")
+                asyncio.run_coroutine_threadsafe(
+                    _recover_stream(voice_client, guild_id, channel, track, source.position, error),
+                    voice_client.loop
+                )
+                return
+
+            _stream_retries.pop(guild_id, None)
+            metrics.inc("tracks_ended_total", outcome="stopped" if stopped else "error" if error else "finished")
+
             if error:
                 asyncio.run_coroutine_threadsafe(
-                    channel.send(f"⚠️ Error playing **{title}**: {str(error)}. Skipping to next song."), 
+                    channel.send(f"⚠️ Error playing **{title}**: {str(error)}. Skipping to next song."),
                     voice_client.loop
                 )
-                # Don't loop on error
-                guild_queues.remove_current_track(guild_id)
-            else:
-                if loop_mode == "one":
-                    pass  # Don't modify the queue
-                elif loop_mode == "all":
-                    guild_queues.rotate_queue(guild_id)
-                else:
-                    guild_queues.remove_current_track(guild_id)
 
+            # The queue is only ever changed on the event loop, never from this audio thread
             asyncio.run_coroutine_threadsafe(
-                play_next_song(voice_client, guild_id, channel), 
+                _advance_queue(voice_client, guild_id, channel, track, error),
                 voice_client.loop
             )
 
         voice_client.play(source, after=after_play)
-        await channel.send(f"Now playing: **{title}**")
-        
+        _now_playing[guild_id] = source
+        metrics.observe("track_start_seconds", time.perf_counter() - started_at, source=source_kind)
+        ended_at = _ended_at.pop(guild_id, None)
+        if ended_at is not None:
+            metrics.observe("track_transition_seconds", time.perf_counter() - ended_at)
+        _starting_guilds.discard(guild_id)
+        guild_queues.set_channels(guild_id, channel.id, voice_client.channel.id)
+        _schedule_prefetch(guild_id, track, start_offset, encoding)
+        track_index.record_play(guild_id, track)
+        # Measured in the background the first time, later plays get the gain
+        loudness_analyzer.schedule(track)
+
+        # A track resumed after a stream failure was already announced
+        if guild_id not in _stream_retries:
+            await now_playing_announcer.announce(channel, f"Now playing: **{title}**")
+
     except Exception as e:
+        _starting_guilds.discard(guild_id)
+        retry = _stream_retries.get(guild_id)
+        if retry is not None and retry[0] is track:
+            await _recover_stream(voice_client, guild_id, channel, track, start_offset, e)
+            return
         await channel.send(f"❌ Error playing **{title}**: {str(e)}. Skipping to next song.")
         guild_queues.remove_current_track(guild_id)
         await play_next_song(voice_client, guild_id, channel)
+
+metrics.gauge("players_active", lambda: len(_now_playing))
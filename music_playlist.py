@@ -0,0 +1,104 @@
+"""
+Virtual playlists, entries are listed in chunks and paged into the queue as playback approaches
+"""
+import asyncio
+from itertools import islice
+from config import YDL_BASE_OPTIONS, PLAYLIST_CHUNK_SIZE, PLAYLIST_PAGE_RETRY_LIMIT, PLAYLIST_PAGE_RETRY_BACKOFF
+from config import MAX_VIRTUAL_PLAYLIST_SIZE
+from music_queue import guild_queues, PlaylistSegment
+from music_ytdlp import search_ytdlp_async, make_track
+from music_scheduler import PRIORITY_INTERACTIVE
+
+UNAVAILABLE_TITLES = ("[Private video]", "[Deleted video]")
+
+# Segments within this many items of the current track are paged in
+PAGE_IN_LOOKAHEAD = 1
+
+_expansions = {}  # {PlaylistSegment: asyncio.Task}, so one segment is listed once at a time
+
+async def list_playlist_entries(url, start, end, guild_id, requester, priority):
+    """List entries start..end of a playlist as tracks
+
+    Returns the playlist info, or None when listing failed, the playable tracks and the
+    number of unavailable entries that were skipped.
+    """
+    # Only list the entries, stream URLs are resolved when each track is about to play
+    ydl_options = YDL_BASE_OPTIONS.copy()
+    ydl_options["extract_flat"] = "in_playlist"
+    ydl_options["playlist_items"] = f"{start}-{end}"
+    result = await search_ytdlp_async(url, ydl_options, guild_id, priority)
+    if result is None:
+        return None, [], 0
+
+    playlist_title = result.get("title", "Unknown Playlist")
+    tracks = []
+    unavailable_count = 0
+    for index, entry in enumerate(result.get("entries", [result]), start):
+        if entry.get("title") in UNAVAILABLE_TITLES:
+            unavailable_count += 1
+            continue
+
+        track = make_track(entry, requester)
+        if not track.webpage_url and not track.stream_url:
+            unavailable_count += 1
+            continue
+
+        track.origin = (url, playlist_title, index)
+        tracks.append(track)
+    return result, tracks, unavailable_count
+
+async def page_in_segment(guild_id, segment, priority):
+    """List the next chunk of a segment into the queue, waiting for a listing already running"""
+    task = _expansions.get(segment)
+    if task is None:
+        task = asyncio.create_task(_expand_segment(guild_id, segment, priority))
+        _expansions[segment] = task
+        task.add_done_callback(lambda _: _expansions.pop(segment, None))
+    await asyncio.shield(task)
+
+async def _expand_segment(guild_id, segment, priority):
+    """List the next chunk of a segment, backing off after a failed listing"""
+    end = min(segment.start + PLAYLIST_CHUNK_SIZE - 1, segment.end or MAX_VIRTUAL_PLAYLIST_SIZE)
+    try:
+        result, tracks, _ = await list_playlist_entries(
+            segment.playlist_url, segment.start, end, guild_id, segment.requester, priority
+        )
+    except Exception as e:
+        print(f"Error listing playlist {segment.playlist_url}: {str(e)}")
+        result = None
+
+    if result is None:
+        # Usually a rate limit or network error, keep the segment and try again
+        segment.listing_failures += 1
+        if segment.listing_failures >= PLAYLIST_PAGE_RETRY_LIMIT:
+            print(f"Giving up on the remaining entries of {segment.playlist_url}")
+            guild_queues.expand_segment(guild_id, segment, [], segment.start - 1, last=True)
+            return
+        await asyncio.sleep(PLAYLIST_PAGE_RETRY_BACKOFF * 2 ** (segment.listing_failures - 1))
+        return
+
+    segment.listing_failures = 0
+    entries = result.get("entries")
+    if not entries:
+        # The playlist got shorter, drop what is left of it
+        guild_queues.expand_segment(guild_id, segment, [], segment.start - 1, last=True)
+        return
+    # A playlist of unknown length ends with the first short listing, or at the size limit
+    last = segment.end is None and (len(entries) < end - segment.start + 1 or end >= MAX_VIRTUAL_PLAYLIST_SIZE)
+    guild_queues.expand_segment(guild_id, segment, tracks, end, last)
+
+async def page_in_upcoming(guild_id, priority=PRIORITY_INTERACTIVE):
+    """Page in playlist entries until the current and next items are tracks
+
+    Every pass lists a chunk, drops a segment or counts a failed listing towards
+    dropping it, so this always ends.
+    """
+    while True:
+        queue = guild_queues.peek_queue(guild_id)
+        segment = next(
+            (item for item in islice(queue, PAGE_IN_LOOKAHEAD + 1) if isinstance(item, PlaylistSegment)),
+            None,
+        )
+        if segment is None:
+            return
+        await page_in_segment(guild_id, segment, priority)
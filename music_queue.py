@@ -1,70 +1,612 @@
 """
 Queue management for music playback
 """
-from collections import deque
+import random
+import sys
+import time
+from itertools import islice
+from music_metrics import metrics
+
+class Track:
+    """Queue record for one track, its stream URL is resolved just before playback"""
+    __slots__ = (
+        "id", "webpage_url", "title", "uploader", "duration", "requester",
+        "stream_url", "expires_at", "acodec", "asr", "sort_key", "origin",
+    )
+
+    def __init__(self, id, webpage_url, title, uploader=None, duration=None, requester=None):
+        self.id = id
+        self.webpage_url = webpage_url
+        self.title = title
+        self.uploader = uploader
+        self.duration = duration
+        self.requester = requester  # Discord user id
+        # Filled in when the stream is resolved
+        self.stream_url = None
+        self.expires_at = 0
+        self.acodec = None
+        self.asr = None
+        self.sort_key = 0.0  # Orders the track within its queue, assigned by TrackQueue
+        self.origin = None  # (playlist_url, playlist_title, index) for tracks paged in from a playlist
+
+    def to_dict(self):
+        """Get the persistent fields of the track"""
+        data = {
+            "id": self.id,
+            "webpage_url": self.webpage_url,
+            "title": self.title,
+            "uploader": self.uploader,
+            "duration": self.duration,
+            "requester": self.requester,
+        }
+        if self.origin is not None:
+            data["origin"] = list(self.origin)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a track from its persistent fields"""
+        track = cls(
+            data["id"], data["webpage_url"], data["title"],
+            uploader=data.get("uploader"), duration=data.get("duration"), requester=data.get("requester"),
+        )
+        if data.get("origin"):
+            track.origin = tuple(data["origin"])
+        return track
+
+class PlaylistSegment:
+    """Placeholder for playlist entries start..end (1-based) that haven't been listed yet
+
+    Entries are paged into the queue in chunks as playback approaches, so a long
+    playlist costs one record until it is reached. end is None for playlists yt-dlp
+    can't count, e.g. YouTube mixes, until a listing comes up short.
+    """
+    __slots__ = ("playlist_url", "title", "start", "end", "requester", "sort_key", "listing_failures")
+    duration = None  # Unknown until the entries are listed
+
+    def __init__(self, playlist_url, title, start, end, requester=None):
+        self.playlist_url = playlist_url
+        self.title = title
+        self.start = start
+        self.end = end
+        self.requester = requester
+        self.sort_key = 0.0
+        self.listing_failures = 0  # Failed listings in a row, not persisted
+
+    @property
+    def count(self):
+        """Number of entries still to be listed, None if the end of the playlist is unknown"""
+        if self.end is None:
+            return None
+        return self.end - self.start + 1
+
+    def to_dict(self):
+        """Get the persistent fields of the segment"""
+        return {
+            "segment": True,
+            "playlist_url": self.playlist_url,
+            "title": self.title,
+            "start": self.start,
+            "end": self.end,
+            "requester": self.requester,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a segment from its persistent fields"""
+        return cls(data["playlist_url"], data["title"], data["start"], data["end"], requester=data.get("requester"))
+
+def queue_item_from_dict(data):
+    """Rebuild a persisted queue item, a track or a playlist segment"""
+    if data.get("segment"):
+        return PlaylistSegment.from_dict(data)
+    return Track.from_dict(data)
+
+class TrackQueue:
+    """Track list with O(1) head pop/rotate, index-based edits and a running total duration
+
+    Items before self.head have already been popped, the list is compacted once they
+    make up half of it, which keeps pops and rotations amortized O(1). Every track
+    carries an increasing sort key so a single change can be persisted on its own.
+    """
+    def __init__(self):
+        self.items = []
+        self.head = 0
+        self.total_duration = 0
+
+    def __len__(self):
+        return len(self.items) - self.head
+
+    def __iter__(self):
+        return islice(self.items, self.head, None)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        return self.items[self.head + index]
+
+    def append(self, track):
+        track.sort_key = self._tail_key() + 1
+        self.items.append(track)
+        self.total_duration += track.duration or 0
+
+    def load(self, tracks):
+        """Replace the contents with tracks that already carry their sort keys"""
+        self.items = sorted(tracks, key=lambda track: track.sort_key)
+        self.head = 0
+        self.total_duration = sum(track.duration or 0 for track in self.items)
+
+    def popleft(self):
+        """Remove and return the first track"""
+        track = self[0]
+        self.items[self.head] = None
+        self.head += 1
+        self._compact()
+        self.total_duration -= track.duration or 0
+        return track
+
+    def rotate(self):
+        """Move the first track to the end"""
+        track = self[0]
+        tail_key = self._tail_key()
+        self.items[self.head] = None
+        self.head += 1
+        track.sort_key = tail_key + 1
+        self.items.append(track)
+        self._compact()
+
+    def remove(self, index):
+        """Remove and return the track at an index"""
+        self[index]  # Bounds check
+        track = self.items.pop(self.head + index)
+        self.total_duration -= track.duration or 0
+        return track
+
+    def move(self, from_index, to_index):
+        """Move a track from one index to another
+
+        Returns the track and whether every sort key had to be renumbered.
+        """
+        self[from_index], self[to_index]  # Bounds check
+        track = self.items.pop(self.head + from_index)
+        self.items.insert(self.head + to_index, track)
+
+        # Key the track between its new neighbours
+        prev_key = self[to_index - 1].sort_key if to_index > 0 else None
+        next_key = self[to_index + 1].sort_key if to_index + 1 < len(self) else None
+        if prev_key is None and next_key is None:
+            return track, False
+        if prev_key is None:
+            track.sort_key = next_key - 1
+        elif next_key is None:
+            track.sort_key = prev_key + 1
+        else:
+            track.sort_key = (prev_key + next_key) / 2
+            if not prev_key < track.sort_key < next_key:
+                # Ran out of float precision between the neighbours
+                self.renumber()
+                return track, True
+        return track, False
+
+    def insert(self, index, tracks):
+        """Insert tracks before an index, keyed between their neighbours
+
+        Returns whether every sort key had to be renumbered.
+        """
+        if index < len(self):
+            next_key = self[index].sort_key
+        else:
+            next_key = self._tail_key() + len(tracks) + 1
+        prev_key = self[index - 1].sort_key if index > 0 else next_key - len(tracks) - 1
+        step = (next_key - prev_key) / (len(tracks) + 1)
+
+        self.items[self.head + index:self.head + index] = tracks
+        for offset, track in enumerate(tracks, 1):
+            track.sort_key = prev_key + step * offset
+            self.total_duration += track.duration or 0
+
+        keys = [prev_key] + [track.sort_key for track in tracks] + [next_key]
+        if any(a >= b for a, b in zip(keys, keys[1:])):
+            # Ran out of float precision between the neighbours
+            self.renumber()
+            return True
+        return False
+
+    def entry_count(self):
+        """Count the tracks including the playlist entries not paged in yet, as far as they are known"""
+        return sum((item.count or 0) if isinstance(item, PlaylistSegment) else 1 for item in self)
+
+    def shuffle(self, start=0):
+        """Shuffle the tracks from start onwards, renumbering every sort key"""
+        tail = self.items[self.head + start:]
+        random.shuffle(tail)
+        self.items[self.head + start:] = tail
+        self.renumber()
+
+    def renumber(self):
+        """Reassign evenly spaced sort keys in queue order"""
+        for index, track in enumerate(self):
+            track.sort_key = float(index)
+
+    def update_duration(self, track, duration):
+        """Change the duration of a queued track, keeping the total in step"""
+        self.total_duration += (duration or 0) - (track.duration or 0)
+        track.duration = duration
+
+    def clear(self):
+        self.items = []
+        self.head = 0
+        self.total_duration = 0
+
+    def _tail_key(self):
+        return self.items[-1].sort_key if len(self) else -1.0
+
+    def _compact(self):
+        """Drop popped slots once they make up half of the list"""
+        if self.head > 32 and self.head * 2 > len(self.items):
+            del self.items[:self.head]
+            self.head = 0
 
 class GuildQueues:
     """Manages song queues for multiple guilds"""
     def __init__(self):
-        self.queues = {}  # {guild_id: deque()}
+        self.queues = {}  # {guild_id: TrackQueue}
         self.loop_status = {}  # {guild_id: "none" | "one" | "all"}
         self.default_platforms = {}  # {guild_id: platform}
         self.download_errors = {}  # {guild_id: count}
+        self.channels = {}  # {guild_id: (text_channel_id, voice_channel_id)} while connected
+        self.positions = {}  # {guild_id: seconds into the current track}
+        self.bitrates = {}  # {guild_id: kbps} overriding the channel-aware encoder bitrate
+        self.last_activity = {}  # {guild_id: time.monotonic() of the last change}
+        self.store = None  # Optional QueueStore every change is written behind to
+    
+    def restore(self, store, keep=None):
+        """Load the persisted queues and player state, then write changes to the store
+
+        keep(guild_id) can limit which guilds are loaded, e.g. to this process's shards.
+        """
+        for guild_id, state in store.load().items():
+            if keep is None or keep(guild_id):
+                self._apply_state(guild_id, state)
+        self.store = store
+    
+    def _apply_state(self, guild_id, state):
+        """Put a guild's stored queue and player state back in memory"""
+        if state["tracks"]:
+            queue = TrackQueue()
+            queue.load(state["tracks"])
+            self.queues[guild_id] = queue
+        if state["loop_status"] != "none":
+            self.loop_status[guild_id] = state["loop_status"]
+        self.default_platforms[guild_id] = state["platform"]
+        if state["position"]:
+            self.positions[guild_id] = state["position"]
+        if state["bitrate"]:
+            self.bitrates[guild_id] = state["bitrate"]
+        if state["voice_channel_id"]:
+            self.channels[guild_id] = (state["text_channel_id"], state["voice_channel_id"])
+        self.last_activity[guild_id] = time.monotonic()
+    
+    def _ensure_loaded(self, guild_id):
+        """Load a guild that isn't in memory from the store, e.g. after it was evicted
+
+        The guild counts as loaded from then on, even with nothing stored, so the store
+        is asked once per guild until it is evicted again.
+        """
+        if self.store and guild_id not in self.last_activity:
+            state = self.store.load(guild_id).get(guild_id)
+            if state is not None:
+                self._apply_state(guild_id, state)
+            else:
+                self.last_activity[guild_id] = time.monotonic()
+    
+    def touch(self, guild_id):
+        """Mark the guild as active so it isn't reclaimed"""
+        self._ensure_loaded(guild_id)
+        self.last_activity[guild_id] = time.monotonic()
+    
+    def idle_guilds(self, max_idle):
+        """Get the guilds without any activity for max_idle seconds"""
+        now = time.monotonic()
+        return [guild_id for guild_id, last in self.last_activity.items() if now - last >= max_idle]
+    
+    def evict(self, guild_id):
+        """Drop a guild's state from memory, it is reloaded from the store if it comes back
+
+        A guild is kept while it has changes waiting for a flush, and without a store
+        while it still has tracks queued. Returns whether it was evicted.
+        """
+        if self.store and self.store.has_pending(guild_id):
+            return False
+        if not self.store and self.queues.get(guild_id):
+            return False
+        self._drop(guild_id)
+        return True
+
+    def forget(self, guild_id):
+        """Drop everything kept for a guild, in memory and in the store, e.g. after leaving it"""
+        self._drop(guild_id)
+        if self.store:
+            self.store.delete_guild(guild_id)
+
+    def _drop(self, guild_id):
+        for state in (self.queues, self.loop_status, self.default_platforms, self.download_errors,
+                      self.channels, self.positions, self.bitrates, self.last_activity):
+            state.pop(guild_id, None)
+    
+    def memory_usage(self, guild_id):
+        """Estimate the bytes held in memory for a guild"""
+        size = 0
+        queue = self.queues.get(guild_id)
+        if queue is not None:
+            size += sys.getsizeof(queue) + sys.getsizeof(queue.items)
+            for track in queue:
+                size += sys.getsizeof(track)
+                for slot in type(track).__slots__:
+                    value = getattr(track, slot)
+                    if isinstance(value, str):
+                        size += sys.getsizeof(value)
+        for state in (self.loop_status, self.default_platforms, self.download_errors,
+                      self.channels, self.positions, self.bitrates, self.last_activity):
+            if guild_id in state:
+                size += sys.getsizeof(state[guild_id])
+        return size
+    
+    def stats(self):
+        """Get the number of guilds and tracks held in memory and their estimated size"""
+        guild_ids = set(self.queues) | set(self.loop_status) | set(self.default_platforms) | set(self.last_activity)
+        return {
+            "guilds": len(guild_ids),
+            "tracks": sum(len(queue) for queue in self.queues.values()),
+            "memory_bytes": sum(self.memory_usage(guild_id) for guild_id in guild_ids),
+        }
+    
+    def _save_state(self, guild_id):
+        """Write the guild's player state behind to the store"""
+        if self.store:
+            text_channel_id, voice_channel_id = self.channels.get(guild_id, (None, None))
+            self.store.save_state(guild_id, {
+                "loop_status": self.get_loop_status(guild_id),
+                "platform": self.get_default_platform(guild_id),
+                "text_channel_id": text_channel_id,
+                "voice_channel_id": voice_channel_id,
+                "position": self.positions.get(guild_id, 0),
+                "bitrate": self.bitrates.get(guild_id),
+            })
     
     def get_queue(self, guild_id):
         """Get the queue for a guild, creating it if it doesn't exist"""
+        self.touch(guild_id)
         if guild_id not in self.queues:
-            self.queues[guild_id] = deque()
+            self.queues[guild_id] = TrackQueue()
         return self.queues[guild_id]
     
+    def peek_queue(self, guild_id):
+        """Get the queue for a guild without creating it, empty if there is none"""
+        self._ensure_loaded(guild_id)
+        return self.queues.get(guild_id, ())
+    
     def get_loop_status(self, guild_id):
         """Get the loop status for a guild"""
+        self._ensure_loaded(guild_id)
         return self.loop_status.get(guild_id, "none")
     
     def set_loop_status(self, guild_id, status):
         """Set the loop status for a guild"""
-        self.loop_status[guild_id] = status
+        self.touch(guild_id)
+        if status == "none":
+            self.loop_status.pop(guild_id, None)
+        else:
+            self.loop_status[guild_id] = status
+        self._save_state(guild_id)
     
     def get_default_platform(self, guild_id):
         """Get the default platform for a guild"""
+        self._ensure_loaded(guild_id)
         return self.default_platforms.get(guild_id, "youtube")
     
     def set_default_platform(self, guild_id, platform):
         """Set the default platform for a guild"""
-        self.default_platforms[guild_id] = platform
+        self.touch(guild_id)
+        if self.default_platforms.get(guild_id) != platform:
+            self.default_platforms[guild_id] = platform
+            self._save_state(guild_id)
+    
+    def set_channels(self, guild_id, text_channel_id, voice_channel_id):
+        """Record the channels the guild is playing in, so playback can resume after a restart"""
+        self.touch(guild_id)
+        if self.channels.get(guild_id) != (text_channel_id, voice_channel_id):
+            self.channels[guild_id] = (text_channel_id, voice_channel_id)
+            self._save_state(guild_id)
+    
+    def clear_channels(self, guild_id):
+        """Forget the channels once the guild disconnects"""
+        if self.channels.pop(guild_id, None) is not None:
+            self._save_state(guild_id)
+    
+    def get_playback_position(self, guild_id):
+        """Get the recorded position in the current track, in seconds"""
+        self._ensure_loaded(guild_id)
+        return self.positions.get(guild_id, 0)
     
-    def add_track(self, guild_id, audio_url, title):
-        """Add a track to the queue"""
-        self.get_queue(guild_id).append((audio_url, title))
+    def set_playback_position(self, guild_id, position):
+        """Record the position in the current track, in seconds"""
+        self._ensure_loaded(guild_id)
+        if self.positions.get(guild_id, 0) != position:
+            if position:
+                self.positions[guild_id] = position
+            else:
+                self.positions.pop(guild_id, None)
+            self._save_state(guild_id)
+    
+    def get_bitrate_override(self, guild_id):
+        """Get the encoder bitrate set for a guild in kbps, None for automatic"""
+        self._ensure_loaded(guild_id)
+        return self.bitrates.get(guild_id)
+    
+    def set_bitrate_override(self, guild_id, bitrate):
+        """Set the encoder bitrate for a guild in kbps, None for automatic"""
+        self.touch(guild_id)
+        if self.bitrates.get(guild_id) != bitrate:
+            if bitrate:
+                self.bitrates[guild_id] = bitrate
+            else:
+                self.bitrates.pop(guild_id, None)
+            self._save_state(guild_id)
+    
+    def add_track(self, guild_id, track):
+        """Add a track record to the queue"""
+        self.get_queue(guild_id).append(track)
+        if self.store:
+            self.store.save_track(guild_id, track)
     
     def get_current_track(self, guild_id):
         """Get the current track"""
-        queue = self.get_queue(guild_id)
+        queue = self.peek_queue(guild_id)
         if not queue:
             return None
         return queue[0]
     
+    def get_next_track(self, guild_id):
+        """Get the track that will play after the current one, honouring the loop mode"""
+        queue = self.peek_queue(guild_id)
+        if not queue:
+            return None
+        loop_mode = self.get_loop_status(guild_id)
+        if loop_mode == "one":
+            return queue[0]
+        if len(queue) > 1:
+            return queue[1]
+        if loop_mode == "all":
+            return queue[0]
+        return None
+    
     def remove_current_track(self, guild_id):
         """Remove the current track"""
-        queue = self.get_queue(guild_id)
+        queue = self.peek_queue(guild_id)
         if queue:
-            return queue.popleft()
+            track = queue.popleft()
+            if self.store:
+                self.store.delete_track(guild_id, track.sort_key)
+            return track
         return None
     
     def rotate_queue(self, guild_id):
-        """Rotate the queue by moving the first item to the end"""
-        queue = self.get_queue(guild_id)
-        if queue:
-            queue.rotate(-1)
+        """Rotate the queue by moving the first item to the end
+
+        A track paged in from a playlist goes back into a segment at the end instead, so
+        looping a long playlist keeps only the tracks near playback in memory.
+        """
+        queue = self.peek_queue(guild_id)
+        if not queue:
+            return
+        track = queue[0]
+        if getattr(track, "origin", None) is None or len(queue) == 1:
+            old_key = track.sort_key
+            queue.rotate()
+            if self.store:
+                self.store.move_track(guild_id, old_key, queue[-1].sort_key)
+            return
+
+        self.remove_current_track(guild_id)
+        playlist_url, playlist_title, index = track.origin
+        tail = queue[-1]
+        if (isinstance(tail, PlaylistSegment) and tail.playlist_url == playlist_url
+                and tail.end is not None and tail.end + 1 == index):
+            tail.end = index
+            if self.store:
+                self.store.save_track(guild_id, tail)
+        else:
+            self.add_track(guild_id, PlaylistSegment(playlist_url, playlist_title, index, index, track.requester))
+    
+    def expand_segment(self, guild_id, segment, tracks, listed_to, last=False):
+        """Insert the tracks listed from a segment before it, and shrink it to the rest
+
+        listed_to is the last playlist entry that was listed, last drops the rest of the
+        segment, e.g. when the listing came up short. Nothing changes if the segment left
+        the queue while it was being listed.
+        """
+        queue = self.queues.get(guild_id)
+        index = next((i for i, item in enumerate(queue or ()) if item is segment), None)
+        if index is None:
+            return
+
+        self.touch(guild_id)
+        renumbered = queue.insert(index, tracks) if tracks else False
+        segment.start = listed_to + 1
+        exhausted = last or (segment.end is not None and segment.start > segment.end)
+        if exhausted:
+            queue.remove(index + len(tracks))
+        if self.store:
+            if renumbered:
+                self.store.replace_tracks(guild_id, list(queue))
+                return
+            for track in tracks:
+                self.store.save_track(guild_id, track)
+            if exhausted:
+                self.store.delete_track(guild_id, segment.sort_key)
+            else:
+                self.store.save_track(guild_id, segment)
     
     def clear_queue(self, guild_id):
         """Clear the queue for a guild"""
+        self._ensure_loaded(guild_id)
         if guild_id in self.queues:
             self.queues[guild_id].clear()
+            if self.store:
+                self.store.clear_tracks(guild_id)
+    
+    def remove_track(self, guild_id, index):
+        """Remove the track at an index of the queue"""
+        track = self.get_queue(guild_id).remove(index)
+        if self.store:
+            self.store.delete_track(guild_id, track.sort_key)
+        return track
+    
+    def move_track(self, guild_id, from_index, to_index):
+        """Move a track to another position in the queue"""
+        queue = self.get_queue(guild_id)
+        old_key = queue[from_index].sort_key
+        track, renumbered = queue.move(from_index, to_index)
+        if self.store:
+            if renumbered:
+                self.store.replace_tracks(guild_id, list(queue))
+            else:
+                self.store.move_track(guild_id, old_key, track.sort_key)
+        return track
+    
+    def shuffle_queue(self, guild_id):
+        """Shuffle the upcoming tracks, keeping the current one in place"""
+        queue = self.get_queue(guild_id)
+        queue.shuffle(start=1)
+        if self.store:
+            self.store.replace_tracks(guild_id, list(queue))
+    
+    def set_track_duration(self, guild_id, track, duration):
+        """Set the duration of a queued track once it is known"""
+        queue = self.queues.get(guild_id)
+        if queue is not None and any(queued is track for queued in queue):
+            queue.update_duration(track, duration)
+            if self.store:
+                self.store.save_track(guild_id, track)
+        else:
+            track.duration = duration
+    
+    def total_duration(self, guild_id):
+        """Get the total duration of the queue in seconds"""
+        queue = self.peek_queue(guild_id)
+        return queue.total_duration if queue else 0
     
     def queue_length(self, guild_id):
-        """Get the length of the queue"""
-        return len(self.queues.get(guild_id, []))
+        """Get the length of the queue, a playlist segment counts as one item"""
+        return len(self.peek_queue(guild_id))
+    
+    def entry_count(self, guild_id):
+        """Get the number of tracks queued, including playlist entries not paged in yet"""
+        queue = self.peek_queue(guild_id)
+        return queue.entry_count() if queue else 0
     
     def increment_error_count(self, guild_id):
         """Increment the error count for a guild"""
@@ -78,7 +620,10 @@ class GuildQueues:
     
     def reset_error_count(self, guild_id):
         """Reset the error count for a guild"""
-        self.download_errors[guild_id] = 0
+        self.download_errors.pop(guild_id, None)
 
 # Create a global instance
-guild_queues = GuildQueues()
\ No newline at end of file
+guild_queues = GuildQueues()
+metrics.gauge("queued_tracks", lambda: sum(len(queue) for queue in guild_queues.queues.values()))
+metrics.gauge("guilds_in_memory", lambda: len(guild_queues.last_activity))
+metrics.gauge("queue_memory_bytes", lambda: guild_queues.stats()["memory_bytes"])
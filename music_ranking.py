@@ -0,0 +1,91 @@
+"""
+Ranking of search results against the user's query
+"""
+import math
+import re
+from functools import lru_cache
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+# Title words marking an alternative version, penalized unless the query asks for them
+VARIANT_WORDS = frozenset((
+    "cover", "covers", "lyrics", "lyric", "live", "remix", "karaoke", "instrumental", "acoustic",
+    "nightcore", "slowed", "reverb", "sped", "8d", "reaction", "tutorial", "lesson", "piano",
+    "guitar", "drum", "bass", "boosted", "mashup", "parody", "edit", "loop", "hour",
+))
+
+# Words marking the original upload, from the artist or label
+ORIGINAL_WORDS = frozenset(("official", "topic", "vevo"))
+
+# Durations outside this range are unlikely to be a single song, in seconds
+PLAUSIBLE_DURATION = (60, 15 * 60)
+
+# Score weights
+COVERAGE_WEIGHT = 1.0  # Share of query words found in the title or uploader
+PRECISION_WEIGHT = 0.3  # Share of title words the query asked for
+UPLOADER_WEIGHT = 0.3  # Uploader named in the query, usually the artist
+ORIGINAL_WEIGHT = 0.15
+VARIANT_PENALTY = 0.5
+DURATION_PENALTY = 0.3
+VIEWS_WEIGHT = 0.2  # Scaled against the most viewed result
+RANK_WEIGHT = 0.1  # The platform's own order, best first
+
+@lru_cache(maxsize=8192)
+def tokenize(text):
+    """Split text into lowercase word tokens, cached since search results repeat"""
+    return frozenset(TOKEN_PATTERN.findall(text.lower()))
+
+def _uploader_tokens(entry):
+    """Get the words of the uploader or channel name, without the suffixes labels add"""
+    uploader = entry.get("uploader") or entry.get("channel") or ""
+    return tokenize(uploader) - ORIGINAL_WORDS
+
+def score_entries(entries, query):
+    """Score every entry against the query, higher is a better match
+
+    Entries are scored as one batch since views are compared against the most viewed
+    result and the platform's order counts as a prior.
+    """
+    query_tokens = tokenize(query)
+    asked_variants = query_tokens & VARIANT_WORDS
+    max_views = max((entry.get("view_count") or 0 for entry in entries), default=0)
+    log_max_views = math.log1p(max_views)
+
+    scores = []
+    for index, entry in enumerate(entries):
+        title_tokens = tokenize(entry.get("title") or "")
+        uploader_tokens = _uploader_tokens(entry)
+        score = 0.0
+
+        if query_tokens:
+            matched = query_tokens & (title_tokens | uploader_tokens)
+            score += COVERAGE_WEIGHT * len(matched) / len(query_tokens)
+            if title_tokens:
+                score += PRECISION_WEIGHT * len(query_tokens & title_tokens) / len(title_tokens)
+            if uploader_tokens and uploader_tokens <= query_tokens:
+                score += UPLOADER_WEIGHT
+
+        if (title_tokens | tokenize(entry.get("uploader") or entry.get("channel") or "")) & ORIGINAL_WORDS:
+            score += ORIGINAL_WEIGHT
+        if (title_tokens - asked_variants) & VARIANT_WORDS:
+            score -= VARIANT_PENALTY
+
+        # Long mixes and short clips are fine when the query asks for a variant
+        duration = entry.get("duration")
+        if duration and not asked_variants and not PLAUSIBLE_DURATION[0] <= duration <= PLAUSIBLE_DURATION[1]:
+            score -= DURATION_PENALTY
+
+        views = entry.get("view_count")
+        if views and log_max_views:
+            score += VIEWS_WEIGHT * math.log1p(views) / log_max_views
+
+        score += RANK_WEIGHT * (1 - index / len(entries))
+        scores.append(score)
+    return scores
+
+def pick_best_match(entries, query):
+    """Pick the search result most likely to be the song the user asked for"""
+    if len(entries) == 1:
+        return entries[0]
+    scores = score_entries(entries, query)
+    return entries[max(range(len(entries)), key=scores.__getitem__)]
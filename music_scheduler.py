@@ -0,0 +1,119 @@
+"""
+Extraction scheduler with a dedicated worker pool and per-guild fairness
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import EXTRACTION_WORKERS, EXTRACTION_USE_PROCESSES
+from music_metrics import metrics
+
+# Job priorities, lower runs first
+PRIORITY_INTERACTIVE = 0  # A user is waiting on this, e.g. a single /play search
+PRIORITY_BULK = 1  # Background work, e.g. listing the rest of a playlist or prefetching
+
+class ExtractionScheduler:
+    """Runs extraction jobs on a bounded pool, round-robin across guilds, interactive first"""
+    def __init__(self, workers, use_processes=False):
+        self.workers = workers
+        self.use_processes = use_processes
+        self.executor = None  # Created on first use so importing doesn't spawn workers
+        self.pending = (OrderedDict(), OrderedDict())  # Per priority {guild_id: deque(job)}
+        self.running = 0
+        self.completed = 0
+        self.wait_times = deque(maxlen=1000)  # Recent queue wait times in seconds
+
+    def _get_executor(self):
+        """Get the worker pool, creating it on first use"""
+        if self.executor is None:
+            if self.use_processes:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extract")
+        return self.executor
+
+    async def run(self, guild_id, func, *args, priority=PRIORITY_INTERACTIVE):
+        """Queue a job for a guild and wait for its result
+
+        In process mode func and args must be picklable.
+        """
+        future = asyncio.get_running_loop().create_future()
+        guild_jobs = self.pending[priority].setdefault(guild_id, deque())
+        guild_jobs.append((future, func, args, time.monotonic()))
+        self._dispatch()
+        return await future
+
+    def _dispatch(self):
+        """Start queued jobs while there are free workers"""
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+
+            future, func, args, queued_at = job
+            if future.cancelled():
+                continue
+
+            wait_time = time.monotonic() - queued_at
+            self.wait_times.append(wait_time)
+            metrics.observe("extraction_queue_wait_seconds", wait_time)
+            self.running += 1
+            work = loop.run_in_executor(self._get_executor(), func, *args)
+            work.add_done_callback(lambda done, future=future: self._finish(future, done))
+
+    def _next_job(self):
+        """Pick the next job, highest priority first and round-robin across guilds"""
+        for guild_jobs in self.pending:
+            if not guild_jobs:
+                continue
+
+            guild_id, jobs = next(iter(guild_jobs.items()))
+            job = jobs.popleft()
+            # Move the guild to the back so every other guild gets a turn first
+            del guild_jobs[guild_id]
+            if jobs:
+                guild_jobs[guild_id] = jobs
+            return job
+        return None
+
+    def _finish(self, future, done):
+        """Hand a finished job's result to its caller and start the next job"""
+        self.running -= 1
+        self.completed += 1
+
+        if not future.cancelled():
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+        self._dispatch()
+
+    def queue_depth(self, priority=None):
+        """Get the number of queued jobs, for one priority or in total"""
+        priorities = self.pending if priority is None else (self.pending[priority],)
+        return sum(len(jobs) for guild_jobs in priorities for jobs in guild_jobs.values())
+
+    def stats(self):
+        """Get queue depth, worker usage and wait time metrics"""
+        wait_times = sorted(self.wait_times)
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "completed": self.completed,
+            "queued_interactive": self.queue_depth(PRIORITY_INTERACTIVE),
+            "queued_bulk": self.queue_depth(PRIORITY_BULK),
+            "wait_avg": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            "wait_p95": wait_times[int(len(wait_times) * 0.95)] if wait_times else 0.0,
+        }
+
+# Create a global instance
+extraction_scheduler = ExtractionScheduler(EXTRACTION_WORKERS, EXTRACTION_USE_PROCESSES)
+metrics.gauge("extraction_queue_depth", lambda: [
+    ({"priority": "interactive"}, extraction_scheduler.queue_depth(PRIORITY_INTERACTIVE)),
+    ({"priority": "bulk"}, extraction_scheduler.queue_depth(PRIORITY_BULK)),
+])
+metrics.gauge("extraction_workers_busy", lambda: extraction_scheduler.running)
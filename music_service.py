@@ -0,0 +1,183 @@
+"""
+Multi-process sharding with one extraction and cache service shared over a Unix socket
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+from music_cache import extraction_cache
+from music_ytdlp import extract_coalesced, use_remote_extractor, prewarm_extraction
+
+# Playlist results can be large, allow long lines on the socket
+STREAM_LIMIT = 64 * 1024 * 1024
+
+class ExtractionService:
+    """Serves extractions and cache invalidations to the shard processes
+
+    Requests and replies are JSON lines. Every shard shares this process's cache,
+    extraction pool and in-flight coalescing, so a track one shard resolved is a
+    cache hit for all of them.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.server = None
+
+    async def start(self):
+        """Listen on the socket, replacing one left behind by a crash"""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = await asyncio.start_unix_server(self._handle, self.socket_path, limit=STREAM_LIMIT)
+
+    async def _handle(self, reader, writer):
+        """Answer one shard's requests concurrently until it disconnects"""
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self._respond(json.loads(line), writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as e:
+            print(f"Extraction service connection error: {str(e)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _respond(self, request, writer, write_lock):
+        if request["op"] == "invalidate":
+            extraction_cache.invalidate(request["kind"], request["key"])
+            return
+
+        try:
+            info, failed = await extract_coalesced(
+                request["query"], request["ydl_opts"], request["guild_id"], request["priority"]
+            )
+            reply = {"id": request["id"], "info": info, "failed": failed}
+        except Exception as e:
+            reply = {"id": request["id"], "error": str(e)}
+
+        async with write_lock:
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+class ExtractionClient:
+    """A shard process's connection to the extraction service, opened on first use"""
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.reader = None
+        self.writer = None
+        self.pending = {}  # {request id: asyncio.Future}
+        self.next_id = 0
+        self.connect_lock = None  # Created in the bot's event loop
+
+    async def _connect(self):
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+            self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path, limit=STREAM_LIMIT)
+            asyncio.create_task(self._read_replies(self.reader))
+
+    async def _read_replies(self, reader):
+        """Hand replies to their waiting requests, failing them all if the service goes away"""
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                future = self.pending.pop(reply["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in reply:
+                    future.set_exception(RuntimeError(reply["error"]))
+                else:
+                    future.set_result((reply["info"], reply["failed"]))
+        except (ConnectionError, ValueError) as e:
+            print(f"Extraction service connection error: {str(e)}")
+
+        # Reconnect on the next request
+        self.reader = self.writer = None
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("extraction service disconnected"))
+
+    async def extract(self, query, ydl_opts, guild_id, priority):
+        """Extract through the service, returning the info and whether anything failed"""
+        if self.writer is None:
+            await self._connect()
+
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self._send({
+            "id": request_id, "op": "extract", "query": query, "ydl_opts": ydl_opts,
+            "guild_id": guild_id, "priority": priority,
+        })
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    def invalidate(self, kind, key):
+        """Drop an entry from the shared cache, without waiting for the service"""
+        if self.writer is not None:
+            self._send({"op": "invalidate", "kind": kind, "key": key})
+
+    def _send(self, message):
+        self.writer.write(json.dumps(message).encode() + b"\n")
+
+def get_shard_ranges(shard_count, processes):
+    """Split the shard ids into one contiguous range per process"""
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [shard_ids for shard_ids in ranges if shard_ids]
+
+def run_shard_process(token, shard_ids, shard_count, socket_path):
+    """Run the bot for a range of shards, extracting through the shared service"""
+    # Imported here so the service process doesn't set up a bot
+    from bot import setup_bot
+    from music_queue import guild_queues
+
+    use_remote_extractor(ExtractionClient(socket_path))
+    bot = setup_bot(shard_ids, shard_count)
+    bot.run(token)
+
+    if guild_queues.store:
+        guild_queues.store.close()
+
+def run_sharded(token, shard_count, processes, socket_path):
+    """Run the extraction service here and the shards spread over worker processes"""
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_shard_process, args=(token, shard_ids, shard_count, socket_path))
+        for shard_ids in get_shard_ranges(shard_count, processes)
+    ]
+    asyncio.run(_serve_shards(socket_path, workers))
+
+async def _serve_shards(socket_path, workers):
+    """Serve extractions until every shard process has exited"""
+    service = ExtractionService(socket_path)
+    await service.start()
+    for worker in workers:
+        worker.start()
+    prewarm = asyncio.create_task(prewarm_extraction())
+
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(None, worker.join) for worker in workers))
+    finally:
+        prewarm.cancel()
+        service.close()
@@ -0,0 +1,119 @@
+"""
+Audio source creation for playback
+"""
+import hashlib
+import discord
+from config import FFMPEG_OPTIONS, BROADCAST_ENABLED
+from music_broadcast import broadcast_hub, FRAME_DURATION
+from music_audio_cache import audio_cache
+from music_encoding import DEFAULT_ENCODING, DEGRADED_COMPLEXITY
+from music_loudness import loudness_analyzer
+from music_supervisor import ffmpeg_supervisor
+from music_metrics import metrics
+from utils import normalize_query
+
+# Codecs that can be remuxed into Discord's Ogg/Opus stream without re-encoding
+PASSTHROUGH_CODECS = ("opus",)
+
+def can_passthrough(track):
+    """Check if the track's selected format is Opus and can skip the re-encode"""
+    acodec = (track.acodec or "").lower()
+    # Opus always decodes at 48 kHz, anything else means yt-dlp reported an odd format
+    return acodec in PASSTHROUGH_CODECS and track.asr in (None, 48000)
+
+def needs_transcode(track):
+    """Check if streaming the track runs an Opus encoder rather than a remux"""
+    return not can_passthrough(track) or loudness_analyzer.get_gain(track) is not None
+
+def get_audio_cache_key(track, gain=None):
+    """Get the file-safe key a track's audio is cached under, with a loudness gain applied"""
+    key = normalize_query(track.webpage_url or "")
+    if gain is not None:
+        key += f"|gain={gain}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def open_cached_audio(track, start_offset=0):
+    """Open the track's cached audio, or None if it has to be resolved and streamed
+
+    The file is opened right away, another thread or process can evict it at any time.
+    """
+    if not audio_cache.enabled or not track.webpage_url:
+        return None
+    return audio_cache.open(get_audio_cache_key(track, loudness_analyzer.get_gain(track)), start_offset)
+
+def create_audio_source(track, start_offset=0, encoding=DEFAULT_ENCODING, degraded=False):
+    """Create an audio source streaming a track through ffmpeg, try open_cached_audio first
+
+    With BROADCAST_ENABLED, guilds starting the same track at the same offset share one
+    ffmpeg process. With the audio cache enabled, a track that plays through from the
+    start is recorded so later plays can be served from disk. Tracks with a measured
+    loudness are played with its gain correction. A degraded source, for when every
+    transcode slot is taken, skips the gain so it can be remuxed or encodes at the
+    lowest complexity.
+    """
+    gain = None if degraded else loudness_analyzer.get_gain(track)
+    if degraded:
+        encoding = encoding._replace(complexity=DEGRADED_COMPLEXITY)
+    if not track.stream_url:
+        raise RuntimeError("the stream URL has not been resolved")
+
+    if BROADCAST_ENABLED:
+        # Remuxed streams are the same for everyone, transcoded ones only share an encoding and gain
+        passthrough = can_passthrough(track) and gain is None
+        key = (track.webpage_url or track.stream_url, start_offset, None if passthrough else (encoding, gain))
+        source = broadcast_hub.subscribe(key, lambda offset: _create_ffmpeg_source(track, start_offset + offset, encoding, gain))
+    else:
+        source = _create_ffmpeg_source(track, start_offset, encoding, gain)
+
+    if audio_cache.enabled and track.webpage_url and start_offset == 0:
+        source = audio_cache.record(get_audio_cache_key(track, gain), source, track.duration)
+    return source
+
+def _create_ffmpeg_source(track, start_offset=0, encoding=DEFAULT_ENCODING, gain=None):
+    """Spawn ffmpeg for a track, starting start_offset seconds in, with an optional gain in dB"""
+    before_options = FFMPEG_OPTIONS["before_options"]
+    if start_offset > 0:
+        before_options += f" -ss {start_offset:.2f}"
+
+    # FFmpegOpusAudio copies the stream for codec "copy", "opus" and "libopus" alike and
+    # only encodes with libopus for any other value, None included. A gain has to go
+    # through the filter graph, which ffmpeg refuses to combine with a stream copy.
+    transcode = not can_passthrough(track) or gain is not None
+    options = FFMPEG_OPTIONS["options"]
+    if gain is not None:
+        options += f" -af volume={gain}dB"
+    if transcode:
+        options += f" -compression_level {encoding.complexity}"
+    with metrics.timer("ffmpeg_spawn_seconds", codec="libopus" if transcode else "copy"):
+        return ffmpeg_supervisor.spawn(
+            track,
+            transcode,
+            codec=None if transcode else "copy",
+            bitrate=encoding.bitrate,
+            before_options=before_options,
+            options=options,
+        )
+
+class TrackedSource(discord.AudioSource):
+    """Wraps a source and counts the frames sent, to know the playback position"""
+    def __init__(self, source, start_offset=0):
+        self.source = source
+        self.start_offset = start_offset
+        self.frames = 0
+
+    @property
+    def position(self):
+        """Seconds into the track, counting from the start of the stream"""
+        return self.start_offset + self.frames * FRAME_DURATION
+
+    def read(self):
+        frame = self.source.read()
+        if frame:
+            self.frames += 1
+        return frame
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
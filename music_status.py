@@ -0,0 +1,122 @@
+"""
+Rate-friendly status messages, edited in place and throttled per channel
+"""
+import asyncio
+import time
+import discord
+from config import STATUS_EDIT_INTERVAL, NOW_PLAYING_MIN_INTERVAL
+
+class StatusMessage:
+    """One followup message per interaction, edited in place as the request progresses
+
+    The first update sends the message, later ones are coalesced so it is edited at most
+    once every interval seconds. Notes, e.g. warnings, are kept below the headline.
+    """
+    def __init__(self, interaction, interval=STATUS_EDIT_INTERVAL):
+        self.interaction = interaction
+        self.interval = interval
+        self.message = None
+        self.headline = ""
+        self.notes = []
+        self.shown = None  # Content the message currently shows
+        self.last_edit = 0.0
+        self.edit_task = None
+        self.lock = asyncio.Lock()  # Sends and edits go out one at a time, in order
+
+    @property
+    def content(self):
+        return "\n".join([self.headline] + self.notes)
+
+    async def update(self, headline):
+        """Replace the headline"""
+        self.headline = headline
+        await self._schedule()
+
+    async def add_note(self, note):
+        """Add a line below the headline"""
+        self.notes.append(note)
+        await self._schedule()
+
+    async def finish(self, headline=None):
+        """Show the final status right away, without waiting for the debounce"""
+        if headline is not None:
+            self.headline = headline
+        if self.edit_task is not None:
+            self.edit_task.cancel()
+            self.edit_task = None
+        await self._push()
+
+    async def _schedule(self):
+        """Send the message on the first update, otherwise edit it once the interval has passed"""
+        if self.message is None:
+            await self._push()
+        elif self.edit_task is None:
+            delay = max(0.0, self.last_edit + self.interval - time.monotonic())
+            self.edit_task = asyncio.create_task(self._push_later(delay))
+
+    async def _push_later(self, delay):
+        await asyncio.sleep(delay)
+        self.edit_task = None
+        await self._push()
+
+    async def _push(self):
+        """Send or edit the message so it shows the latest content"""
+        async with self.lock:
+            content = self.content
+            if content == self.shown:
+                return
+            try:
+                if self.message is None:
+                    self.message = await self.interaction.followup.send(content, wait=True)
+                else:
+                    await self.message.edit(content=content)
+                self.shown = content
+            except discord.HTTPException as e:
+                print(f"Status message error: {str(e)}")
+            self.last_edit = time.monotonic()
+
+class NowPlayingAnnouncer:
+    """Posts "Now playing" messages, at most one per channel every min_interval seconds
+
+    Announcements made inside the window are coalesced and only the latest one is
+    posted when it ends, so skipping through tracks doesn't flood the channel.
+    """
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.last_sent = {}  # {channel_id: time.monotonic() of the last announcement}
+        self.pending = {}  # {channel_id: content waiting for the window to end}
+        self.tasks = {}  # {channel_id: asyncio.Task}
+
+    async def announce(self, channel, content):
+        """Post content now, or at the end of the channel's window replacing anything pending"""
+        wait = self.last_sent.get(channel.id, float("-inf")) + self.min_interval - time.monotonic()
+        if wait <= 0 and channel.id not in self.tasks:
+            await self._send(channel, content)
+            return
+
+        self.pending[channel.id] = content
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.create_task(self._send_later(channel, wait))
+
+    async def _send_later(self, channel, delay):
+        await asyncio.sleep(delay)
+        del self.tasks[channel.id]
+        content = self.pending.pop(channel.id, None)
+        if content is not None:
+            await self._send(channel, content)
+
+    async def _send(self, channel, content):
+        now = time.monotonic()
+        if len(self.last_sent) > 1024:
+            # Forget channels whose window ended long ago
+            self.last_sent = {
+                channel_id: sent for channel_id, sent in self.last_sent.items() if now - sent < self.min_interval
+            }
+        self.last_sent[channel.id] = now
+        try:
+            await channel.send(content)
+        except discord.HTTPException as e:
+            print(f"Now playing message error: {str(e)}")
+
+# Create a global instance
+now_playing_announcer = NowPlayingAnnouncer(NOW_PLAYING_MIN_INTERVAL)
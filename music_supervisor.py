@@ -0,0 +1,224 @@
+"""
+Supervisor owning every ffmpeg process of this bot process, with a cap on transcodes, a stall watchdog and usage accounting
+"""
+import asyncio
+import os
+import threading
+import time
+import discord
+from config import FFMPEG_MAX_TRANSCODES, FFMPEG_ADMISSION_TIMEOUT, FFMPEG_STALL_SECONDS
+from music_metrics import metrics
+
+ADMISSION_POLL_INTERVAL = 0.25  # Seconds between checks for a free transcode slot
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def read_process_usage(pid):
+    """Get the CPU seconds and resident bytes of a process from /proc, or None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    # The command name can contain spaces, fields are counted from after it, utime and stime come 12th and 13th
+    fields = stat[stat.rfind(")") + 2:].split()
+    try:
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (ValueError, IndexError):
+        return None
+    return cpu_seconds, rss_pages * PAGE_SIZE
+
+class SupervisedProcess:
+    """An ffmpeg process registered with the supervisor, with its sampled CPU and memory use"""
+    def __init__(self, process, kind, title):
+        self.process = process
+        self.kind = kind  # "transcode", "remux" or "analysis"
+        self.title = title
+        self.started_at = time.monotonic()
+        self.read_started = None  # Set while a read is blocked on ffmpeg's output
+        self.stalled = False
+        self.cpu_seconds = 0.0
+        self.cpu_percent = 0.0
+        self.rss_bytes = 0
+        self.sampled_at = None
+
+    def is_running(self):
+        return self.process.poll() is None
+
+    def sample(self, now):
+        """Update the CPU and memory figures from /proc"""
+        usage = read_process_usage(self.process.pid)
+        if usage is None:
+            return
+        cpu_seconds, self.rss_bytes = usage
+        if self.sampled_at is not None and now > self.sampled_at:
+            self.cpu_percent = 100 * (cpu_seconds - self.cpu_seconds) / (now - self.sampled_at)
+        self.cpu_seconds = cpu_seconds
+        self.sampled_at = now
+
+class SupervisedAnalysis(SupervisedProcess):
+    """A loudness analysis run as an asyncio subprocess, accounted for but not capped"""
+    def __init__(self, process, title):
+        super().__init__(process, "analysis", title)
+
+    def is_running(self):
+        return self.process.returncode is None
+
+class SupervisedSource(SupervisedProcess, discord.AudioSource):
+    """An ffmpeg source registered with the supervisor, timing each read for the stall watchdog"""
+    def __init__(self, supervisor, source, transcode, title):
+        super().__init__(source._process, "transcode" if transcode else "remux", title)
+        self.supervisor = supervisor
+        self.source = source
+
+    def read(self):
+        self.read_started = time.monotonic()
+        try:
+            frame = self.source.read()
+        finally:
+            self.read_started = None
+        if not frame and self.stalled:
+            # Fail instead of ending, so the player retries the stream
+            raise RuntimeError(f"ffmpeg produced no audio for {self.supervisor.stall_seconds}s")
+        return frame
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.supervisor.release(self)
+        self.source.cleanup()
+
+class FFmpegSupervisor:
+    """Spawns and watches every ffmpeg process, for playback and for loudness analysis
+
+    Transcodes run an Opus encoder each and are capped, remuxes and loudness analyses
+    are only counted. The cap applies per bot process, shard processes each have their
+    own. New playback waits in line for a transcode slot until the admission timeout
+    and is then degraded by the caller instead. A watchdog kills processes a read has
+    been blocked on for too long, the read then fails into the player's stream retry,
+    and samples every process's CPU and memory use.
+    """
+    def __init__(self, max_transcodes, admission_timeout, stall_seconds):
+        self.max_transcodes = max_transcodes
+        self.admission_timeout = admission_timeout
+        self.stall_seconds = stall_seconds
+        self.processes = set()  # {SupervisedProcess}, added on spawn and removed on cleanup or release
+        self.lock = threading.Lock()  # Sources are cleaned up from audio threads
+        self.admission_lock = None  # Created in the bot's event loop, a FIFO line for slots
+        self.waiting = 0
+
+    def spawn(self, track, transcode, **options):
+        """Start ffmpeg for a track's stream URL, options go to FFmpegOpusAudio"""
+        source = discord.FFmpegOpusAudio(track.stream_url, **options)
+        supervised = SupervisedSource(self, source, transcode, track.title)
+        with self.lock:
+            self.processes.add(supervised)
+        return supervised
+
+    async def spawn_analysis(self, title, args, **options):
+        """Start an ffmpeg analysis as an asyncio subprocess, release it once it has exited"""
+        process = await asyncio.create_subprocess_exec(*args, **options)
+        supervised = SupervisedAnalysis(process, title)
+        with self.lock:
+            self.processes.add(supervised)
+        return supervised
+
+    def release(self, supervised):
+        with self.lock:
+            self.processes.discard(supervised)
+
+    def running(self):
+        """Get the processes still running"""
+        with self.lock:
+            processes = list(self.processes)
+        return [supervised for supervised in processes if supervised.is_running()]
+
+    def count(self, kind):
+        """Count the running processes of one kind, transcode, remux or analysis"""
+        return sum(1 for supervised in self.running() if supervised.kind == kind)
+
+    def is_full(self):
+        """Check if every transcode slot is taken"""
+        return self.count("transcode") >= self.max_transcodes
+
+    async def admit(self):
+        """Wait in line for a transcode slot, returning False if none freed up in time"""
+        if self.admission_lock is None:
+            self.admission_lock = asyncio.Lock()
+        if not self.admission_lock.locked() and not self.is_full():
+            metrics.inc("ffmpeg_admissions_total", outcome="admitted")
+            return True
+
+        deadline = time.monotonic() + self.admission_timeout
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.admission_lock.acquire(), self.admission_timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("ffmpeg_admissions_total", outcome="degraded")
+            return False
+        finally:
+            self.waiting -= 1
+
+        try:
+            while self.is_full():
+                if time.monotonic() >= deadline:
+                    metrics.inc("ffmpeg_admissions_total", outcome="degraded")
+                    return False
+                await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+        finally:
+            self.admission_lock.release()
+        metrics.inc("ffmpeg_admissions_total", outcome="queued")
+        return True
+
+    def check(self):
+        """Kill stalled processes and sample the usage of the others"""
+        now = time.monotonic()
+        for supervised in self.running():
+            read_started = supervised.read_started
+            if read_started is not None and now - read_started > self.stall_seconds and not supervised.stalled:
+                print(f"ffmpeg stalled for {now - read_started:.0f}s playing {supervised.title}, stopping it")
+                supervised.stalled = True
+                supervised.process.kill()
+                metrics.inc("ffmpeg_stalls_total")
+                continue
+            supervised.sample(now)
+
+    async def run(self, interval):
+        """Watch the processes every interval seconds, until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            self.check()
+
+    def stats(self):
+        """Get the live usage of every running process"""
+        now = time.monotonic()
+        return [
+            {
+                "pid": supervised.process.pid,
+                "title": supervised.title,
+                "kind": supervised.kind,
+                "age": now - supervised.started_at,
+                "cpu_percent": supervised.cpu_percent,
+                "rss_bytes": supervised.rss_bytes,
+            }
+            for supervised in self.running()
+        ]
+
+    def _usage_gauge(self, field):
+        """Get one usage figure per running process, labelled by pid and kind"""
+        return [({"pid": process["pid"], "kind": process["kind"]}, process[field]) for process in self.stats()]
+
+# Create a global instance
+ffmpeg_supervisor = FFmpegSupervisor(FFMPEG_MAX_TRANSCODES, FFMPEG_ADMISSION_TIMEOUT, FFMPEG_STALL_SECONDS)
+
+metrics.gauge("ffmpeg_processes_active", lambda: [
+    ({"kind": kind}, ffmpeg_supervisor.count(kind)) for kind in ("transcode", "remux", "analysis")
+])
+metrics.gauge("ffmpeg_admission_waiting", lambda: ffmpeg_supervisor.waiting)
+metrics.gauge("ffmpeg_process_cpu_percent", lambda: ffmpeg_supervisor._usage_gauge("cpu_percent"))
+metrics.gauge("ffmpeg_process_rss_bytes", lambda: ffmpeg_supervisor._usage_gauge("rss_bytes"))
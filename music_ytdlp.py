@@ -2,8 +2,24 @@
 YouTube-DL wrapper for music extraction
 """
 import asyncio
-import yt_dlp
-from music_queue import guild_queues
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+from config import YDL_BASE_OPTIONS, STREAM_URL_DEFAULT_TTL, STREAM_URL_EXPIRY_MARGIN, EXTRACTION_WORKERS
+from music_queue import guild_queues, Track
+from music_cache import extraction_cache
+from music_scheduler import extraction_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from music_metrics import metrics
+from music_index import track_index
+from utils import normalize_query, get_platform_from_url
+
+# Fields kept from yt-dlp results, the rest (formats, thumbnails, subtitles...) is dropped
+COMPACT_FIELDS = (
+    "_type", "id", "title", "duration", "uploader", "channel", "webpage_url", "url", "ie_key",
+    "extractor_key", "acodec", "asr", "ext", "abr", "view_count", "playlist_count",
+)
+METADATA_FIELDS = ("id", "title", "duration", "uploader", "channel", "webpage_url", "extractor_key", "view_count")
 
 class MyLogger:
     """Custom YoutubeDL logger to capture errors"""
@@ -14,23 +30,252 @@ class MyLogger:
         pass
 
     def error(self, msg):
+        metrics.inc("ytdlp_errors_total")
         print(f"YT-DLP Error: {msg}")
 
-async def search_ytdlp_async(query, ydl_opts, guild_id):
-    """Run YT-DLP extraction asynchronously"""
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _extract(query, ydl_opts, guild_id))
+# yt-dlp, imported on first use or by the prewarm since loading it delays startup
+_yt_dlp = None
+_yt_dlp_lock = threading.Lock()
+
+def get_yt_dlp():
+    """Import yt-dlp on first use"""
+    global _yt_dlp
+    if _yt_dlp is None:
+        with _yt_dlp_lock:
+            if _yt_dlp is None:
+                import yt_dlp
+                _yt_dlp = yt_dlp
+    return _yt_dlp
+
+# Option profiles /play and playback use, warmed up ahead of the first request
+PREWARM_PROFILES = (
+    dict(YDL_BASE_OPTIONS, extract_flat=True),
+    dict(YDL_BASE_OPTIONS, extract_flat="in_playlist"),
+    dict(YDL_BASE_OPTIONS),
+    dict(YDL_BASE_OPTIONS, noplaylist=True),
+)
+
+# Options that change per call and are set on a pooled instance instead of keying the pool
+PER_CALL_OPTIONS = ("playlist_items",)
+
+class YoutubeDLPool:
+    """Long-lived YoutubeDL instances per option profile, each used by one thread at a time"""
+    def __init__(self, max_idle_per_profile):
+        self.max_idle_per_profile = max_idle_per_profile
+        self.idle = {}  # {profile: [YoutubeDL]}
+        self.lock = threading.Lock()
+        self.created = 0
+
+    @contextmanager
+    def checkout(self, ydl_opts):
+        """Borrow an instance configured with the given options"""
+        profile_opts = {key: value for key, value in ydl_opts.items() if key not in PER_CALL_OPTIONS}
+        profile = repr(sorted(profile_opts.items()))
+
+        with self.lock:
+            instances = self.idle.setdefault(profile, [])
+            ydl = instances.pop() if instances else None
+        if ydl is None:
+            # Construction loads every extractor and sets up the HTTP opener, pay it once
+            ydl = get_yt_dlp().YoutubeDL(dict(profile_opts, logger=MyLogger()))
+            self.created += 1
+
+        for key in PER_CALL_OPTIONS:
+            ydl.params[key] = ydl_opts.get(key)
+
+        try:
+            yield ydl
+        except Exception:
+            # Don't hand an instance that failed mid-extraction to the next caller
+            ydl.close()
+            raise
+
+        with self.lock:
+            if len(instances) < self.max_idle_per_profile:
+                instances.append(ydl)
+                return
+        ydl.close()
+
+    def close_all(self):
+        """Close every idle instance"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for instances in idle.values():
+            for ydl in instances:
+                ydl.close()
+
+# Pooled instances are per process, so process workers each get their own
+ydl_pool = YoutubeDLPool(EXTRACTION_WORKERS)
+
+# Extractions in progress, shared by identical concurrent requests {(kind, key): asyncio.Future}
+_inflight = {}
+
+# Client of a shared extraction service, extractions go there instead of the local pool when set
+_remote_extractor = None
+
+def use_remote_extractor(client):
+    """Send extractions to a shared service, e.g. one serving every shard process"""
+    global _remote_extractor
+    _remote_extractor = client
+
+async def search_ytdlp_async(query, ydl_opts, guild_id, priority=PRIORITY_INTERACTIVE):
+    """Run YT-DLP extraction asynchronously, serving repeated requests from the cache
+
+    Identical requests made while an extraction is running wait for that one instead of
+    starting their own. Results are compacted and may be shared with other callers,
+    treat them as read-only.
+    """
+    info, failed = await extract_coalesced(query, ydl_opts, guild_id, priority)
 
-def _extract(query, ydl_opts, guild_id):
-    """Extract information from YT-DLP"""
-    # Reset error counter for this guild
+    # Error counts are per guild, apply them for every guild that shared the result
     guild_queues.reset_error_count(guild_id)
-    
-    # Add custom logger to options
-    ydl_opts["logger"] = MyLogger()
-    
+    if failed:
+        guild_queues.increment_error_count(guild_id)
+    return info
+
+async def extract_coalesced(query, ydl_opts, guild_id, priority=PRIORITY_INTERACTIVE):
+    """Get an extraction result from the cache, a running extraction or a new one
+
+    Returns the info and whether anything failed.
+    """
+    kind = "search" if ydl_opts.get("extract_flat") else "stream"
+    key = get_cache_key(query, ydl_opts)
+    cached = extraction_cache.get(kind, key)
+    if cached is not None:
+        metrics.inc("extraction_requests_total", kind=kind, result="cached")
+        return cached, False
+
+    inflight_key = (kind, key)
+    future = _inflight.get(inflight_key)
+    if future is not None:
+        metrics.inc("extraction_requests_total", kind=kind, result="shared")
+    else:
+        metrics.inc("extraction_requests_total", kind=kind, result="extracted")
+        future = asyncio.ensure_future(_run_extraction(query, ydl_opts, guild_id, priority, kind, key))
+        _inflight[inflight_key] = future
+        future.add_done_callback(lambda done: _forget_inflight(inflight_key, done))
+
+    # Shielded so one caller giving up doesn't cancel the extraction for the others
+    return await asyncio.shield(future)
+
+async def prewarm_extraction():
+    """Import yt-dlp and build the pooled instances in the background, before the first /play"""
+    if _remote_extractor is not None:
+        return  # The extraction service does the extracting
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        await asyncio.gather(*(
+            extraction_scheduler.run("prewarm", _prewarm, ydl_opts, priority=PRIORITY_BULK)
+            for ydl_opts in PREWARM_PROFILES
+        ))
+    except Exception as e:
+        print(f"Prewarm error: {str(e)}")
+
+def _prewarm(ydl_opts):
+    """Load yt-dlp and leave an instance for ydl_opts in this worker's pool"""
+    with ydl_pool.checkout(ydl_opts):
+        pass
+
+def _forget_inflight(inflight_key, future):
+    """Remove a finished extraction unless a newer one took its place"""
+    if _inflight.get(inflight_key) is future:
+        del _inflight[inflight_key]
+
+async def _run_extraction(query, ydl_opts, guild_id, priority, kind, key):
+    """Run one extraction on the scheduler's worker pool and cache its result"""
+    if _remote_extractor is not None:
+        return await _run_remote_extraction(query, ydl_opts, guild_id, priority, kind, key)
+
+    platform = get_extraction_platform(query)
+    with metrics.timer("extraction_seconds", kind=kind, platform=platform):
+        info, failed = await extraction_scheduler.run(guild_id, _extract, query, ydl_opts, priority=priority)
+    outcome = "failure" if info is None else "partial" if failed else "success"
+    metrics.inc("extractions_total", kind=kind, platform=platform, outcome=outcome)
+    if info is None:
+        return None, failed
+
+    info = compact_info(info)
+    _cache_result(kind, key, info)
+    return info, failed
+
+async def _run_remote_extraction(query, ydl_opts, guild_id, priority, kind, key):
+    """Run one extraction on the shared service, keeping the result in the local cache too"""
+    try:
+        info, failed = await _remote_extractor.extract(query, ydl_opts, guild_id, priority)
+    except (OSError, ConnectionError, RuntimeError) as e:
+        print(f"Extraction service error: {str(e)}")
+        return None, True
+    if info is not None:
+        _cache_result(kind, key, info)
+    return info, failed
+
+def get_extraction_platform(query):
+    """Get the platform a query extracts from, for labelling metrics"""
+    if query.startswith("scsearch"):
+        return "soundcloud"
+    if query.startswith("ytsearch"):
+        return "youtube"
+    return get_platform_from_url(query) or "other"
+
+def get_cache_key(query, ydl_opts):
+    """Build the cache key for a query and the options that change its result"""
+    key = normalize_query(query)
+    if ydl_opts.get("playlist_items"):
+        key += f"|items={ydl_opts['playlist_items']}"
+    if ydl_opts.get("noplaylist") and not key.startswith("youtube:"):
+        key += "|noplaylist"
+    return key
+
+def compact_info(info):
+    """Strip a yt-dlp result down to the fields the bot uses"""
+    compact = {field: info[field] for field in COMPACT_FIELDS if field in info}
+
+    audio_format = get_audio_format_from_track(info)
+    if audio_format is not None and audio_format is not info:
+        for field in ("url", "acodec", "asr", "ext", "abr"):
+            if field in audio_format:
+                compact[field] = audio_format[field]
+
+    if "entries" in info:
+        compact["entries"] = [compact_info(entry) for entry in info["entries"] if entry is not None]
+    return compact
+
+def _cache_result(kind, key, info):
+    """Cache an extraction result, stream URLs only until shortly before they expire"""
+    if kind == "search":
+        extraction_cache.set(kind, key, info)
+        return
+
+    resolved = info.get("entries", [info])
+    now = time.time()
+    expiries = [get_stream_expiry(item["url"]) for item in resolved if item.get("url")]
+    if expiries:
+        extraction_cache.set(kind, key, info, ttl=min(expiries) - STREAM_URL_EXPIRY_MARGIN - now)
+
+    # Metadata outlives the stream URL, keep it separately under the track id
+    for item in resolved:
+        metadata_key = get_metadata_key(item)
+        if metadata_key:
+            metadata = {field: item[field] for field in METADATA_FIELDS if field in item}
+            extraction_cache.set("metadata", metadata_key, metadata)
+            track_index.add(metadata)
+
+def get_metadata_key(info):
+    """Get the platform-qualified id a track's metadata is cached under"""
+    extractor = info.get("extractor_key") or info.get("ie_key")
+    if not extractor or not info.get("id"):
+        return None
+    return f"{extractor.lower()}:{info['id']}"
+
+def get_cached_metadata(info):
+    """Get cached metadata for a flat entry or track, if it was extracted before"""
+    key = get_metadata_key(info)
+    return extraction_cache.get("metadata", key) if key else None
+
+def _extract(query, ydl_opts):
+    """Extract information from YT-DLP, returning the info and whether anything failed"""
+    try:
+        # In process mode this lands in the worker's registry, extraction_seconds covers it
+        with ydl_pool.checkout(ydl_opts) as ydl, metrics.timer("ytdlp_extract_info_seconds"):
             info = ydl.extract_info(query, download=False)
             
             # Check for extraction errors in playlists
@@ -41,25 +286,105 @@ def _extract(query, ydl_opts, guild_id):
                 failed_count = original_count - len(info["entries"])
                 
                 if failed_count > 0:
-                    guild_queues.increment_error_count(guild_id)
+                    return info, True
             
-            return info
+            return info, False
     except Exception as e:
         print(f"Extraction error: {str(e)}")
-        guild_queues.increment_error_count(guild_id)
-        return None
+        return None, True
 
-def get_audio_url_from_track(track):
-    """Extract the audio URL from a track"""
+def get_audio_format_from_track(track):
+    """Get the format dict the audio URL of a track comes from"""
     if track is None:
         return None
         
-    audio_url = track.get("url")
-    if not audio_url and "formats" in track:
+    if track.get("url"):
+        # The selected format's fields are merged into the track itself
+        return track
+    if "formats" in track:
         # Try to get audio URL from formats
         for format in track["formats"]:
-            if format.get("acodec") != "none":
-                audio_url = format.get("url")
-                break
+            if format.get("acodec") != "none" and format.get("url"):
+                return format
     
-    return audio_url
+    return None
+
+def make_track(info, requester=None):
+    """Build a lightweight queue record from a yt-dlp info dict or flat entry"""
+    # Flat entries only point at the track page, full results carry the stream URL
+    is_flat = info.get("_type") in ("url", "url_transparent")
+
+    webpage_url = info.get("webpage_url")
+    if not webpage_url and is_flat:
+        webpage_url = info.get("url")
+    if not webpage_url and info.get("ie_key") == "Youtube" and info.get("id"):
+        webpage_url = f"https://www.youtube.com/watch?v={info['id']}"
+
+    track = Track(
+        info.get("id"),
+        webpage_url,
+        info.get("title") or "Untitled",
+        uploader=info.get("uploader") or info.get("channel"),
+        duration=info.get("duration"),
+        requester=requester,
+    )
+
+    if not is_flat:
+        _store_stream_url(track, get_audio_format_from_track(info))
+    return track
+
+def get_stream_expiry(stream_url):
+    """Get the unix time a signed stream URL expires at"""
+    try:
+        query = parse_qs(urlparse(stream_url).query)
+        # googlevideo URLs carry an "expire" parameter, SoundCloud CDN URLs "Expires"
+        for key in ("expire", "Expires"):
+            if key in query:
+                return int(query[key][0])
+    except (ValueError, TypeError):
+        pass
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+def _store_stream_url(track, audio_format):
+    """Cache a resolved stream URL and its codec on a track record"""
+    audio_format = audio_format or {}
+    stream_url = audio_format.get("url")
+    track.stream_url = stream_url
+    track.expires_at = get_stream_expiry(stream_url) if stream_url else 0
+    track.acodec = audio_format.get("acodec")
+    track.asr = audio_format.get("asr")
+
+def has_fresh_stream_url(track):
+    """Check if the track's cached stream URL is still safely usable"""
+    return bool(track.stream_url) and time.time() < track.expires_at - STREAM_URL_EXPIRY_MARGIN
+
+def invalidate_stream_url(track):
+    """Forget a stream URL the CDN stopped serving, so the next resolve fetches a new one"""
+    track.stream_url = None
+    track.expires_at = 0
+    if track.webpage_url:
+        key = get_cache_key(track.webpage_url, {"noplaylist": True})
+        extraction_cache.invalidate("stream", key)
+        if _remote_extractor is not None:
+            _remote_extractor.invalidate("stream", key)
+
+async def resolve_stream_url(track, guild_id, priority=PRIORITY_INTERACTIVE):
+    """Resolve the stream URL for a queued track, reusing it while it is fresh"""
+    if has_fresh_stream_url(track):
+        return track.stream_url
+
+    if not track.webpage_url:
+        return None
+
+    ydl_options = YDL_BASE_OPTIONS.copy()
+    ydl_options["noplaylist"] = True
+    info = await search_ytdlp_async(track.webpage_url, ydl_options, guild_id, priority)
+    if info is None:
+        return None
+
+    _store_stream_url(track, get_audio_format_from_track(info))
+    if info.get("title"):
+        track.title = info["title"]
+    if info.get("duration") and not track.duration:
+        guild_queues.set_track_duration(guild_id, track, info["duration"])
+    return track.stream_url
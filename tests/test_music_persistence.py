@@ -0,0 +1,145 @@
+"""
+Checks queue changes written behind to the store come back the same after a restart
+"""
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_queue import GuildQueues, Track, PlaylistSegment
+from music_persistence import QueueStore
+
+GUILD = "1"
+PLAYLIST_URL = "https://www.youtube.com/playlist?list=test"
+
+def make_track(index, origin=None):
+    track = Track(str(index), f"https://www.youtube.com/watch?v={index}", f"T{index}", duration=10)
+    if origin is not None:
+        track.origin = (PLAYLIST_URL, "Playlist", origin)
+    return track
+
+class QueueStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.db_path = os.path.join(self.directory.name, "queue_state.sqlite3")
+        self.queues = self.open_queues()
+
+    def open_queues(self):
+        queues = GuildQueues()
+        queues.restore(QueueStore(self.db_path))
+        self.addCleanup(queues.store.close)
+        return queues
+
+    def restart(self):
+        """Flush, then load every guild into a fresh GuildQueues from the same database"""
+        self.queues.store.flush()
+        return self.open_queues()
+
+    def describe(self, queues):
+        """Get the queue as comparable tuples, segments with their remaining range"""
+        return [
+            (item.playlist_url, item.start, item.end) if isinstance(item, PlaylistSegment) else item.title
+            for item in queues.peek_queue(GUILD)
+        ]
+
+    def assertRestored(self):
+        restored = self.restart()
+        self.assertEqual(self.describe(restored), self.describe(self.queues))
+        self.assertEqual(
+            [item.sort_key for item in restored.peek_queue(GUILD)],
+            [item.sort_key for item in self.queues.peek_queue(GUILD)],
+        )
+
+    def test_edits_are_restored(self):
+        for index in range(5):
+            self.queues.add_track(GUILD, make_track(index))
+        self.queues.remove_current_track(GUILD)
+        self.queues.move_track(GUILD, 3, 1)
+        self.queues.remove_track(GUILD, 2)
+        self.queues.rotate_queue(GUILD)
+        self.queues.set_loop_status(GUILD, "all")
+        self.assertRestored()
+        self.assertEqual(self.restart().get_loop_status(GUILD), "all")
+
+    def test_shuffle_is_restored(self):
+        for index in range(10):
+            self.queues.add_track(GUILD, make_track(index))
+        self.queues.shuffle_queue(GUILD)
+        self.assertRestored()
+
+    def test_rotate_merges_into_the_segment_at_the_end(self):
+        for index in range(1, 4):
+            self.queues.add_track(GUILD, make_track(index, origin=index))
+        self.queues.add_track(GUILD, PlaylistSegment(PLAYLIST_URL, "Playlist", 4, 10))
+        self.queues.rotate_queue(GUILD)
+        self.queues.rotate_queue(GUILD)
+        # The paged in entries 1 and 2 went back into the playlist after entry 10
+        self.assertEqual(self.describe(self.queues), ["T3", (PLAYLIST_URL, 4, 10), (PLAYLIST_URL, 1, 2)])
+        self.assertRestored()
+
+    def test_expand_segment_is_restored(self):
+        self.queues.add_track(GUILD, make_track(0))
+        segment = PlaylistSegment(PLAYLIST_URL, "Playlist", 1, 5)
+        self.queues.add_track(GUILD, segment)
+        self.queues.add_track(GUILD, make_track(99))
+
+        self.queues.expand_segment(GUILD, segment, [make_track(1, 1), make_track(2, 2)], 3)
+        self.assertEqual(self.describe(self.queues), ["T0", "T1", "T2", (PLAYLIST_URL, 4, 5), "T99"])
+        self.assertRestored()
+
+        self.queues.expand_segment(GUILD, segment, [make_track(4, 4)], 5)
+        self.assertEqual(self.describe(self.queues), ["T0", "T1", "T2", "T4", "T99"])
+        self.assertRestored()
+
+    def test_segment_of_unknown_length_ends_on_last(self):
+        segment = PlaylistSegment(PLAYLIST_URL, "Mix", 1, None)
+        self.queues.add_track(GUILD, segment)
+        self.queues.expand_segment(GUILD, segment, [make_track(1, 1)], 1)
+        self.assertEqual(self.describe(self.queues), ["T1", (PLAYLIST_URL, 2, None)])
+        self.assertRestored()
+        self.queues.expand_segment(GUILD, segment, [make_track(2, 2)], 2, last=True)
+        self.assertEqual(self.describe(self.queues), ["T1", "T2"])
+        self.assertRestored()
+
+    def test_pending_changes_keep_the_guild_in_memory(self):
+        self.queues.add_track(GUILD, make_track(0))
+        self.assertFalse(self.queues.evict(GUILD))
+        self.queues.store.flush()
+        self.assertTrue(self.queues.evict(GUILD))
+        self.assertEqual(self.describe(self.queues), ["T0"])
+
+    def test_forget_deletes_the_guild(self):
+        self.queues.add_track(GUILD, make_track(0))
+        self.queues.set_default_platform(GUILD, "soundcloud")
+        self.queues.forget(GUILD)
+        self.assertEqual(self.restart().store.load(), {})
+
+    def test_random_edits_are_restored(self):
+        rng = random.Random(1)
+        serial = 0
+        for _ in range(500):
+            length = self.queues.queue_length(GUILD)
+            op = rng.choice(("add", "pop", "rotate", "move", "remove", "shuffle", "flush"))
+            if op == "add" or length < 2:
+                self.queues.add_track(GUILD, make_track(serial))
+                serial += 1
+            elif op == "pop":
+                self.queues.remove_current_track(GUILD)
+            elif op == "rotate":
+                self.queues.rotate_queue(GUILD)
+            elif op == "move":
+                self.queues.move_track(GUILD, rng.randrange(length), rng.randrange(length))
+            elif op == "remove":
+                self.queues.remove_track(GUILD, rng.randrange(length))
+            elif op == "shuffle":
+                self.queues.shuffle_queue(GUILD)
+            else:
+                self.queues.store.flush()
+        self.assertRestored()
+
+if __name__ == "__main__":
+    unittest.main()
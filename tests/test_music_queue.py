@@ -0,0 +1,137 @@
+"""
+Checks TrackQueue edits keep the queue order and the sort keys in step
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music_queue import TrackQueue, Track, PlaylistSegment
+
+def make_tracks(count, duration=10):
+    return [Track(str(i), f"https://www.youtube.com/watch?v={i}", f"T{i}", duration=duration) for i in range(count)]
+
+class TrackQueueTest(unittest.TestCase):
+    def assertConsistent(self, queue):
+        """Check the keys increase in queue order and the total duration adds up"""
+        keys = [track.sort_key for track in queue]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(queue.total_duration, sum(track.duration or 0 for track in queue))
+        self.assertNotIn(None, list(queue))
+
+    def titles(self, queue):
+        return [track.title for track in queue]
+
+    def test_append_and_popleft(self):
+        queue = TrackQueue()
+        for track in make_tracks(3):
+            queue.append(track)
+        self.assertEqual(queue.popleft().title, "T0")
+        self.assertEqual(self.titles(queue), ["T1", "T2"])
+        self.assertConsistent(queue)
+
+    def test_rotate_moves_the_first_track_to_the_end(self):
+        queue = TrackQueue()
+        for track in make_tracks(3):
+            queue.append(track)
+        queue.rotate()
+        self.assertEqual(self.titles(queue), ["T1", "T2", "T0"])
+        self.assertConsistent(queue)
+
+    def test_pops_compact_the_list(self):
+        queue = TrackQueue()
+        for track in make_tracks(100):
+            queue.append(track)
+        for _ in range(80):
+            queue.popleft()
+        self.assertLess(len(queue.items), 100)
+        self.assertEqual(self.titles(queue), [f"T{i}" for i in range(80, 100)])
+        self.assertConsistent(queue)
+
+    def test_move_keys_the_track_between_its_neighbours(self):
+        queue = TrackQueue()
+        for track in make_tracks(4):
+            queue.append(track)
+        track, renumbered = queue.move(3, 1)
+        self.assertEqual(track.title, "T3")
+        self.assertFalse(renumbered)
+        self.assertEqual(self.titles(queue), ["T0", "T3", "T1", "T2"])
+        self.assertConsistent(queue)
+
+    def test_move_renumbers_when_keys_run_out(self):
+        queue = TrackQueue()
+        for track in make_tracks(3):
+            queue.append(track)
+        renumbered = False
+        for _ in range(100):
+            _, renumbered = queue.move(0, 1)
+            if renumbered:
+                break
+        self.assertTrue(renumbered)
+        self.assertConsistent(queue)
+
+    def test_insert_keys_tracks_before_an_index(self):
+        queue = TrackQueue()
+        for track in make_tracks(2):
+            queue.append(track)
+        inserted = [Track(f"n{i}", None, f"N{i}", duration=5) for i in range(3)]
+        self.assertFalse(queue.insert(1, inserted))
+        self.assertEqual(self.titles(queue), ["T0", "N0", "N1", "N2", "T1"])
+        self.assertConsistent(queue)
+
+    def test_remove_and_shuffle(self):
+        queue = TrackQueue()
+        for track in make_tracks(6):
+            queue.append(track)
+        self.assertEqual(queue.remove(2).title, "T2")
+        queue.shuffle(start=1)
+        self.assertEqual(queue[0].title, "T0")
+        self.assertEqual(sorted(self.titles(queue)), ["T0", "T1", "T3", "T4", "T5"])
+        self.assertConsistent(queue)
+
+    def test_entry_count_includes_segments(self):
+        queue = TrackQueue()
+        for track in make_tracks(2):
+            queue.append(track)
+        queue.append(PlaylistSegment("https://www.youtube.com/playlist?list=x", "P", 6, 30))
+        queue.append(PlaylistSegment("https://www.youtube.com/watch?v=a&list=RDa", "Mix", 6, None))
+        self.assertEqual(queue.entry_count(), 2 + 25)
+
+    def test_random_edits_keep_the_queue_consistent(self):
+        rng = random.Random(1)
+        queue = TrackQueue()
+        expected = []
+        serial = 0
+        for _ in range(2000):
+            op = rng.choice(("append", "popleft", "rotate", "move", "insert", "remove"))
+            if op == "append" or not expected:
+                track = Track(str(serial), None, f"T{serial}", duration=rng.choice((None, 10)))
+                serial += 1
+                queue.append(track)
+                expected.append(track)
+            elif op == "popleft":
+                self.assertIs(queue.popleft(), expected.pop(0))
+            elif op == "rotate":
+                queue.rotate()
+                expected.append(expected.pop(0))
+            elif op == "move":
+                from_index, to_index = rng.randrange(len(expected)), rng.randrange(len(expected))
+                queue.move(from_index, to_index)
+                expected.insert(to_index, expected.pop(from_index))
+            elif op == "insert":
+                index = rng.randrange(len(expected) + 1)
+                tracks = [Track(str(serial + i), None, f"T{serial + i}") for i in range(rng.randint(1, 3))]
+                serial += len(tracks)
+                queue.insert(index, tracks)
+                expected[index:index] = tracks
+            else:
+                index = rng.randrange(len(expected))
+                self.assertIs(queue.remove(index), expected.pop(index))
+            self.assertEqual(list(queue), expected)
+        self.assertConsistent(queue)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Checks the ffmpeg command line built for each kind of stream, without running ffmpeg
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord.player
+from music_queue import Track
+import music_source
+from music_source import _create_ffmpeg_source
+from music_encoding import DEFAULT_ENCODING
+from music_loudness import loudness_analyzer, LoudnessStore, get_loudness_key
+from music_audio_cache import AudioCache, FRAME_HEADER
+
+class FakeProcess:
+    """Stands in for the ffmpeg child, recording its argv"""
+    def __init__(self, args, **kwargs):
+        self.args = args
+        self.stdout = open(os.devnull, "rb")
+        self.stdin = None
+        self.pid = 0
+
+    def poll(self):
+        return None
+
+def make_track(acodec, asr):
+    track = Track("test", "https://www.youtube.com/watch?v=test", "Test")
+    track.stream_url = "http://127.0.0.1/test"
+    track.acodec = acodec
+    track.asr = asr
+    return track
+
+class FFmpegArgsTest(unittest.TestCase):
+    def spawn_args(self, track, gain=None, create=None):
+        """Build the ffmpeg source and get the argv it would have run"""
+        spawned = []
+        def popen(args, **kwargs):
+            spawned.append(FakeProcess(args, **kwargs))
+            return spawned[-1]
+
+        with mock.patch.object(discord.player.subprocess, "Popen", popen):
+            source = create() if create else _create_ffmpeg_source(track, 0, DEFAULT_ENCODING, gain)
+        source.cleanup()
+        spawned[0].stdout.close()
+        return spawned[0].args
+
+    def codec(self, args):
+        return args[args.index("-c:a") + 1]
+
+    def test_opus_is_copied(self):
+        args = self.spawn_args(make_track("opus", 48000))
+        self.assertEqual(self.codec(args), "copy")
+        self.assertNotIn("-compression_level", args)
+
+    def test_aac_is_encoded(self):
+        args = self.spawn_args(make_track("mp4a.40.2", 44100))
+        self.assertEqual(self.codec(args), "libopus")
+        self.assertEqual(args[args.index("-b:a") + 1], f"{DEFAULT_ENCODING.bitrate}k")
+        self.assertEqual(args[args.index("-compression_level") + 1], str(DEFAULT_ENCODING.complexity))
+
+    def test_mp3_is_encoded(self):
+        args = self.spawn_args(make_track("mp3", 44100))
+        self.assertEqual(self.codec(args), "libopus")
+
+    def test_gain_is_encoded(self):
+        args = self.spawn_args(make_track("opus", 48000), gain=-3.0)
+        self.assertEqual(self.codec(args), "libopus")
+        self.assertEqual(args[args.index("-af") + 1], "volume=-3.0dB")
+
+    def test_measured_track_is_encoded_with_its_gain(self):
+        track = make_track("opus", 48000)
+        store = LoudnessStore(None, 10)
+        store.set(get_loudness_key(track), -10.0, -4.0)
+        with mock.patch.object(loudness_analyzer, "store", store), \
+                mock.patch.object(loudness_analyzer, "enabled", True), \
+                mock.patch.object(music_source, "BROADCAST_ENABLED", False):
+            args = self.spawn_args(track, create=lambda: music_source.create_audio_source(track))
+        self.assertEqual(self.codec(args), "libopus")
+        self.assertEqual(args[args.index("-af") + 1], "volume=-6.0dB")
+
+class CachedAudioTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = AudioCache(self.directory.name, 1024 ** 2)
+        patcher = mock.patch.object(music_source, "audio_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def store(self, track):
+        """Commit a one-frame recording of the track"""
+        key = music_source.get_audio_cache_key(track)
+        partial_path = os.path.join(self.directory.name, key + ".part")
+        with open(partial_path, "wb") as f:
+            f.write(FRAME_HEADER.pack(3) + b"abc")
+        self.cache.commit(key, partial_path)
+        return key
+
+    def test_cached_track_is_opened(self):
+        track = make_track("opus", 48000)
+        self.store(track)
+        source = music_source.open_cached_audio(track)
+        self.assertEqual(source.read(), b"abc")
+        source.cleanup()
+
+    def test_deleted_recording_is_a_miss(self):
+        track = make_track("opus", 48000)
+        key = self.store(track)
+        os.remove(self.cache.path(key))
+        self.assertIsNone(music_source.open_cached_audio(track))
+        self.assertEqual(self.cache.stats()["files"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,6 @@
 Utility functions for the music bot
 """
 import re
-import difflib
 
 def get_platform_from_url(url):
     """Determine the platform from a URL"""
@@ -20,44 +19,27 @@ def is_playlist_url(url):
     """Check if the URL is a playlist"""
     return "playlist" in url or "list=" in url
 
-def find_best_match(tracks, original_query):
-    """Find best matching track from search results based on user's query"""
-    # Clean the original query for better matching
-    clean_query = original_query.lower().strip()
-    
-    # Extract just the search term from search prefix if present
-    if ":" in clean_query:
-        parts = clean_query.split(":", 1)
-        if len(parts) > 1 and parts[0].endswith("search"):
-            clean_query = parts[1].strip()
-    
-    # If there's only one result, return it
-    if len(tracks) == 1:
-        return tracks[0]
-    
-    # Compare each track title with the query
-    best_match = None
-    highest_ratio = 0
-    
-    for track in tracks:
-        if track is None or "title" not in track:
-            continue
-            
-        title = track["title"].lower()
-        ratio = difflib.SequenceMatcher(None, clean_query, title).ratio()
-        
-        # Boost ratio if exact words from query appear in title
-        query_words = clean_query.split()
-        for word in query_words:
-            if word in title and len(word) > 2:  # Only count meaningful words
-                ratio += 0.1
-                
-        if ratio > highest_ratio:
-            highest_ratio = ratio
-            best_match = track
-    
-    # Return the best match or the first track if no good match
-    return best_match if best_match else tracks[0]
+def normalize_query(query):
+    """Normalize a search query or URL into a stable cache key"""
+    query = query.strip()
+    if is_url(query):
+        # Different URL shapes of the same YouTube video share one key
+        if get_platform_from_url(query) == "youtube" and not is_playlist_url(query):
+            match = re.search(r"(?:v=|youtu\.be/|shorts/)([\w-]{11})", query)
+            if match:
+                return f"youtube:{match.group(1)}"
+        return query
+    return " ".join(query.lower().split())
+
+def format_duration(seconds):
+    """Format a duration in seconds as m:ss or h:mm:ss"""
+    if not seconds:
+        return "?:??"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
 
 def get_search_prefix(platform):
     """Get the search prefix for a platform"""